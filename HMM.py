@@ -1,9 +1,104 @@
 import random
 import argparse
+import copy
 import os
 import math
 import re
+import json
+import shutil
 import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import partial
+import numpy as np
+
+SPARSE_DENSITY = 0.25
+LANDER_SAFE_ZONES = ['2,2', '3,3', '4,4']
+EMISSION_CACHE_SIZE = 4096
+CACHE_SUFFIX = '.hmmc'
+STREAM_REBASE = 1e4
+CACHE_ARRAYS = ['initial', 'emit', 'trans_rows', 'trans_cols', 'trans_probs', 'emit_rows', 'emit_cols']
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.subscribers = []
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.calls = {}
+        self.counters = {}
+        self.maxima = set()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        for callback in self.subscribers:
+            callback('phase', name, seconds)
+
+    def count(self, name, amount=1):
+        amount = int(amount)
+        self.counters[name] = self.counters.get(name, 0) + amount
+        for callback in self.subscribers:
+            callback('count', name, amount)
+
+    def maximum(self, name, value):
+        value = int(value)
+        self.maxima.add(name)
+        if value > self.counters.get(name, 0):
+            self.counters[name] = value
+        for callback in self.subscribers:
+            callback('maximum', name, value)
+
+    def snapshot(self):
+        # hand over everything recorded since the last snapshot, e.g. from a worker process to the parent
+        recorded = (self.timings, self.calls, self.counters, self.maxima)
+        self.reset()
+        return recorded
+
+    def merge(self, recorded):
+        timings, calls, counters, maxima = recorded
+        for name, seconds in timings.items():
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + calls[name]
+            for callback in self.subscribers:
+                callback('phase', name, seconds)
+        for name, value in counters.items():
+            if name in maxima:
+                self.maximum(name, value)
+            else:
+                self.count(name, value)
+
+    def phase(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def report(self):
+        return {
+            'phases': {name: {'seconds': seconds, 'calls': self.calls[name]} for name, seconds in self.timings.items()},
+            'counters': dict(self.counters),
+        }
+
+# call sites check PROFILER.enabled first, so a disabled profiler costs one attribute read
+PROFILER = Profiler()
 
 class Sequence:
     def __init__(self, stateseq, outputseq):
@@ -19,19 +114,834 @@ class Sequence:
     def __len__(self):
         return len(self.outputseq)
 
+class CompiledHMM:
+    def __init__(self, hmm):
+        # states that only appear in the transitions are kept too, so every entry survives the cache
+        self.states = list(hmm.emissions.keys())
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        for from_state, successors in hmm.transitions.items():
+            for state in successors if from_state == '#' else (from_state, *successors):
+                if state not in self.state_index:
+                    self.state_index[state] = len(self.states)
+                    self.states.append(state)
+        self.symbols = []
+        self.symbol_index = {}
+        for emits in hmm.emissions.values():
+            for symbol in emits:
+                if symbol not in self.symbol_index:
+                    self.symbol_index[symbol] = len(self.symbols)
+                    self.symbols.append(symbol)
+        # unseen observations map to an all-zero column past the vocabulary
+        self.unknown = len(self.symbols)
+
+        n = len(self.states)
+        self.initial = np.zeros(n)
+        self.emit = np.zeros((n, len(self.symbols) + 1))
+
+        # (row, column) of every entry in the source dicts, in file order; row -1 is '#'
+        trans_entries = []
+        trans_probs = []
+        emit_entries = []
+        for state, prob in hmm.transitions.get('#', {}).items():
+            self.initial[self.state_index[state]] = prob
+            trans_entries.append((-1, self.state_index[state]))
+            trans_probs.append(prob)
+        for from_state, successors in hmm.transitions.items():
+            if from_state == '#':
+                continue
+            i = self.state_index[from_state]
+            for to_state, prob in successors.items():
+                trans_entries.append((i, self.state_index[to_state]))
+                trans_probs.append(prob)
+        for state, emits in hmm.emissions.items():
+            i = self.state_index[state]
+            for symbol, prob in emits.items():
+                self.emit[i, self.symbol_index[symbol]] = prob
+                emit_entries.append((i, self.symbol_index[symbol]))
+
+        self.trans_rows, self.trans_cols = np.array(trans_entries, dtype=np.int32).reshape(-1, 2).T
+        self.trans_probs = np.array(trans_probs, dtype=float)
+        self.emit_rows, self.emit_cols = np.array(emit_entries, dtype=np.int32).reshape(-1, 2).T
+        self.finish()
+
+    def finish(self, sparse=None):
+        self.backptr_dtype = np.min_scalar_type(max(len(self.states) - 1, 0))
+        self.emission_cache = OrderedDict()
+        self.emission_cache_size = EMISSION_CACHE_SIZE
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.log_initial = None
+        self.log_trans = None
+        self.log_emit = None
+        self.pred_log = None
+        self.build_predecessors(sparse)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        try:
+            os.makedirs(tmp_path, exist_ok=True)
+            for name in CACHE_ARRAYS:
+                np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+            for name, values in (('states', self.states), ('symbols', self.symbols)):
+                with open(os.path.join(tmp_path, name + '.txt'), 'w') as f:
+                    f.write('\n'.join(values))
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except OSError:
+            # e.g. another process recreated the cache between the rmtree and the rename
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    @classmethod
+    def open(cls, path):
+        model = cls.__new__(cls)
+        for name in CACHE_ARRAYS:
+            setattr(model, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+        with open(os.path.join(path, 'states.txt'), 'r') as f:
+            model.states = f.read().split('\n')
+        with open(os.path.join(path, 'symbols.txt'), 'r') as f:
+            model.symbols = f.read().split('\n') if model.emit.shape[1] > 1 else []
+        model.state_index = {state: i for i, state in enumerate(model.states)}
+        model.symbol_index = {symbol: i for i, symbol in enumerate(model.symbols)}
+        model.unknown = len(model.symbols)
+        model.finish()
+        return model
+
+    def to_dicts(self):
+        transitions = {}
+        emissions = {}
+        for i, j, prob in zip(self.trans_rows.tolist(), self.trans_cols.tolist(), self.trans_probs.tolist()):
+            transitions.setdefault('#' if i < 0 else self.states[i], {})[self.states[j]] = prob
+        for i, j in zip(self.emit_rows.tolist(), self.emit_cols.tolist()):
+            emissions.setdefault(self.states[i], {})[self.symbols[j]] = float(self.emit[i, j])
+        return transitions, emissions
+
+    def build_predecessors(self, sparse=None):
+        # predecessor lists in CSR form, grouped by destination state, built from the non-zero entries
+        n = len(self.states)
+        edges = np.flatnonzero((self.trans_rows >= 0) & (self.trans_probs != 0))
+        self.pred_entries = edges[np.lexsort((self.trans_rows[edges], self.trans_cols[edges]))]
+        self.pred_src = self.trans_rows[self.pred_entries].astype(np.intp)
+        self.pred_dst = self.trans_cols[self.pred_entries].astype(np.intp)
+        self.pred_prob = self.trans_probs[self.pred_entries]
+        self.pred_positions = np.arange(len(self.pred_src))
+        counts = np.bincount(self.pred_dst, minlength=n)
+        self.pred_targets = np.flatnonzero(counts)
+        self.pred_counts = counts[self.pred_targets]
+        self.pred_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[self.pred_targets]
+        # the same entries ordered by source, so pruning can pick out just the live states' successors
+        self.succ_order = np.argsort(self.pred_src, kind='stable')
+        self.succ_counts = np.bincount(self.pred_src, minlength=n)
+        self.succ_starts = np.concatenate(([0], np.cumsum(self.succ_counts)[:-1]))
+        self.sparse = 0 < len(self.pred_src) <= SPARSE_DENSITY * n * n if sparse is None else sparse
+        # only the dense engine needs the N x N matrix
+        self.trans = None
+        if not self.sparse:
+            self.trans = np.zeros((n, n))
+            self.trans[self.pred_src, self.pred_dst] = self.pred_prob
+
+    def with_engine(self, sparse):
+        model = copy.copy(self)
+        model.finish(sparse)
+        return model
+
+    def log_tables(self):
+        if self.log_emit is None:
+            with np.errstate(divide='ignore'):
+                self.log_initial = np.log(self.initial)
+                self.log_trans = None if self.sparse else np.log(self.trans)
+                self.log_emit = np.log(self.emit)
+                self.pred_log = np.log(self.pred_prob)
+        return self.log_initial, self.log_trans, self.log_emit
+
+    def emission_column(self, symbol, log_space=False):
+        key = (int(symbol), log_space)
+        column = self.emission_cache.get(key)
+        if column is not None:
+            self.emission_cache.move_to_end(key)
+            self.cache_hits += 1
+            return column
+
+        self.cache_misses += 1
+        table = self.log_tables()[2] if log_space else self.emit
+        column = np.ascontiguousarray(table[:, key[0]])
+        self.emission_cache[key] = column
+        if len(self.emission_cache) > self.emission_cache_size:
+            self.emission_cache.popitem(last=False)
+        return column
+
+    def cache_info(self):
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'size': len(self.emission_cache),
+            'capacity': self.emission_cache_size,
+        }
+
+    def encode(self, sequence):
+        return np.array([self.symbol_index.get(symbol, self.unknown) for symbol in sequence], dtype=np.intp)
+
+    # alpha/delta may carry leading batch dimensions; pruning (active) is only used on a single sequence
+    def propagate(self, alpha):
+        if self.sparse:
+            weights = alpha[..., self.pred_src] * self.pred_prob
+            if alpha.ndim == 1:
+                return np.bincount(self.pred_dst, weights=weights, minlength=len(self.states))
+            result = np.zeros(alpha.shape)
+            result[..., self.pred_targets] = np.add.reduceat(weights, self.pred_starts, axis=-1)
+            return result
+        return alpha @ self.trans
+
+    def active_predecessors(self, active):
+        # positions in the predecessor arrays of every entry leaving an active state, still grouped by destination
+        lengths = self.succ_counts[active]
+        offsets = np.repeat(self.succ_starts[active] - np.cumsum(lengths) + lengths, lengths)
+        return np.sort(self.succ_order[offsets + np.arange(len(offsets))])
+
+    def max_step(self, delta, emit_column, log_space=False, active=None):
+        n = len(self.states)
+        floor = -np.inf if log_space else 0
+        if not self.sparse:
+            trans = self.log_trans if log_space else self.trans
+            if active is not None:
+                delta, trans = delta[active], trans[active]
+            if log_space:
+                scores = delta[..., :, None] + trans + emit_column[..., None, :]
+            else:
+                scores = delta[..., :, None] * trans * emit_column[..., None, :]
+            best = scores.argmax(axis=-2)
+            best_scores = np.take_along_axis(scores, best[..., None, :], axis=-2)[..., 0, :]
+            return best_scores, best if active is None else active[best]
+
+        src, dst, prob = self.pred_src, self.pred_dst, self.pred_log if log_space else self.pred_prob
+        starts, counts, targets, positions = self.pred_starts, self.pred_counts, self.pred_targets, self.pred_positions
+        new_delta = np.full(delta.shape[:-1] + (n,), floor, dtype=float)
+        best = np.zeros(new_delta.shape, dtype=np.intp)
+        if active is not None:
+            selected = self.active_predecessors(active)
+            if not len(selected):
+                return new_delta, best
+            src, dst, prob = src[selected], dst[selected], prob[selected]
+            starts = np.flatnonzero(np.diff(dst, prepend=-1))
+            counts = np.diff(np.append(starts, len(dst)))
+            targets = dst[starts]
+            positions = np.arange(len(dst))
+
+        if log_space:
+            scores = delta[..., src] + prob + emit_column[..., dst]
+        else:
+            scores = delta[..., src] * prob * emit_column[..., dst]
+        best_scores = np.maximum.reduceat(scores, starts, axis=-1)
+        is_best = scores == np.repeat(best_scores, counts, axis=-1)
+        positions = np.where(is_best, positions, scores.shape[-1])
+        first = np.minimum.reduceat(positions, starts, axis=-1)
+        new_delta[..., targets] = best_scores
+        best[..., targets] = src[first]
+        return new_delta, best
+
+    def prune(self, delta, log_space=False, beam=None, threshold=None):
+        floor = -np.inf if log_space else 0
+        active = np.flatnonzero(delta != floor)
+        if threshold is not None and len(active):
+            best = delta[active].max()
+            cutoff = best + math.log(threshold) if log_space else best * threshold
+            active = active[delta[active] >= cutoff]
+        if beam is not None and len(active) > beam:
+            active = np.sort(active[np.argpartition(-delta[active], beam - 1)[:beam]])
+        pruned = np.full(len(delta), floor, dtype=float)
+        pruned[active] = delta[active]
+        return pruned, active
+
+    def back_propagate(self, beta):
+        if self.sparse:
+            weights = self.pred_prob * beta[self.pred_dst]
+            return np.bincount(self.pred_src, weights=weights, minlength=len(self.states))
+        return self.trans @ beta
+
+    # trans_probs lines up with trans_rows/trans_cols, which every re-estimated model shares
+    def with_parameters(self, initial, trans_probs, emit):
+        model = copy.copy(self)
+        model.initial, model.trans_probs, model.emit = initial, trans_probs, emit
+        model.finish()
+        return model
+
+    def forward_backward(self, obs):
+        columns = self.emit[:, obs].T
+        alpha = np.empty(columns.shape)
+        beta = np.empty(columns.shape)
+        scales = np.empty(len(obs))
+
+        current = self.initial * columns[0]
+        for t in range(len(obs)):
+            if t:
+                current = self.propagate(alpha[t - 1]) * columns[t]
+            scales[t] = current.sum()
+            if scales[t] == 0:
+                return None
+            alpha[t] = current / scales[t]
+
+        beta[-1] = 1
+        for t in range(len(obs) - 2, -1, -1):
+            beta[t] = self.back_propagate(columns[t + 1] * beta[t + 1]) / scales[t + 1]
+        return alpha, beta, scales
+
+    def posteriors(self, obs):
+        result = self.forward_backward(obs)
+        if result is None:
+            return None
+        alpha, beta, _ = result
+        return alpha * beta
+
+    def expected_counts(self, obs):
+        result = self.forward_backward(obs)
+        if result is None:
+            return None
+        alpha, beta, scales = result
+        gamma = alpha * beta
+        weighted = self.emit[:, obs[1:]].T * beta[1:] / scales[1:, None]
+
+        # one count per predecessor entry, so the sparse engine never builds an N x N table
+        if self.sparse:
+            flow = np.einsum('ti,ti->i', alpha[:-1][:, self.pred_src], weighted[:, self.pred_dst])
+        else:
+            flow = (alpha[:-1].T @ weighted)[self.pred_src, self.pred_dst]
+        trans_counts = self.pred_prob * flow
+        # gamma[t] is the expected emission count for obs[t]; the caller adds it into its own table
+        return gamma[0], trans_counts, gamma, np.log(scales).sum()
+
+    def forward(self, obs):
+        start = time.perf_counter() if PROFILER.enabled else None
+        alpha = self.initial * self.emission_column(obs[0])
+        for t in range(1, len(obs)):
+            alpha = self.propagate(alpha) * self.emission_column(obs[t])
+        if start is not None:
+            PROFILER.add_time('forward', time.perf_counter() - start)
+            PROFILER.count('forward.observations', len(obs))
+            PROFILER.count('forward.transitions_evaluated', (len(obs) - 1) * self.transitions_per_step())
+        return alpha
+
+    def transitions_per_step(self, active=None):
+        if self.sparse:
+            return len(self.pred_src) if active is None else int(self.succ_counts[active].sum())
+        rows = len(self.states) if active is None else len(active)
+        return rows * len(self.states)
+
+    def viterbi(self, obs, log_space=False, beam=None, threshold=None):
+        profiling = PROFILER.enabled
+        if profiling:
+            start = time.perf_counter()
+            visited = evaluated = pruned = 0
+        pruning = beam is not None or threshold is not None
+        if log_space:
+            delta = self.log_tables()[0] + self.emission_column(obs[0], True)
+            floor = -np.inf
+        else:
+            delta = self.initial * self.emission_column(obs[0])
+            floor = 0
+        backptr = np.zeros((len(obs), len(self.states)), dtype=self.backptr_dtype)
+
+        active = None
+        failed_at = None
+        for t in range(1, len(obs)):
+            if profiling:
+                live = np.count_nonzero(delta != floor)
+            if pruning:
+                delta, active = self.prune(delta, log_space, beam, threshold)
+                if not len(active):
+                    failed_at = t
+                    break
+            if profiling:
+                visited += live
+                pruned += live - len(active) if pruning else 0
+                evaluated += self.transitions_per_step(active)
+            delta, best = self.max_step(delta, self.emission_column(obs[t], log_space), log_space, active)
+            if (delta == floor).all():
+                failed_at = t
+                break
+            backptr[t] = best
+
+        path = None
+        if failed_at is None:
+            path = np.empty(len(obs), dtype=np.intp)
+            path[-1] = delta.argmax()
+            for t in range(len(obs) - 1, 0, -1):
+                path[t - 1] = backptr[t, path[t]]
+
+        if profiling:
+            PROFILER.add_time('viterbi', time.perf_counter() - start)
+            PROFILER.count('viterbi.sequences')
+            PROFILER.count('viterbi.observations', len(obs))
+            PROFILER.maximum('viterbi.max_sequence_length', len(obs))
+            PROFILER.count('viterbi.states_visited', visited)
+            PROFILER.count('viterbi.transitions_evaluated', evaluated)
+            PROFILER.count('viterbi.pruned_cells', pruned)
+            if failed_at is not None:
+                PROFILER.count('viterbi.failed_sequences')
+        return path, failed_at
+
+    def pad(self, sequences):
+        lengths = np.array([len(obs) for obs in sequences], dtype=np.intp)
+        padded = np.full((len(sequences), max(lengths.max(initial=0), 1)), self.unknown, dtype=np.intp)
+        for i, obs in enumerate(sequences):
+            padded[i, :len(obs)] = obs
+        return padded, lengths
+
+    def viterbi_batch(self, sequences):
+        padded, lengths = self.pad(sequences)
+        log_initial, _, log_emit = self.log_tables()
+        delta = log_initial + log_emit[:, padded[:, 0]].T
+        backptr = np.zeros((padded.shape[1], len(sequences), len(self.states)), dtype=self.backptr_dtype)
+        alive = np.ones(len(sequences), dtype=bool)
+
+        for t in range(1, padded.shape[1]):
+            running = lengths > t
+            step, best = self.max_step(delta, log_emit[:, padded[:, t]].T, True)
+            alive &= ~(running & np.isneginf(step).all(axis=1))
+            delta = np.where(running[:, None], step, delta)
+            backptr[t] = best
+
+        paths = []
+        for i, length in enumerate(lengths):
+            if not alive[i] or not length:
+                paths.append(None if length else np.empty(0, dtype=np.intp))
+                continue
+            path = np.empty(length, dtype=np.intp)
+            path[-1] = delta[i].argmax()
+            for t in range(length - 1, 0, -1):
+                path[t - 1] = backptr[t, i, path[t]]
+            paths.append(path)
+        return paths
+
+    def forward_batch(self, sequences):
+        padded, lengths = self.pad(sequences)
+        alpha = self.initial * self.emit[:, padded[:, 0]].T
+        log_likelihood = np.zeros(len(sequences))
+
+        for t in range(padded.shape[1]):
+            if t:
+                step = self.propagate(alpha) * self.emit[:, padded[:, t]].T
+                alpha = np.where((lengths > t)[:, None], step, alpha)
+            totals = alpha.sum(axis=1)
+            current = lengths > t
+            with np.errstate(divide='ignore'):
+                log_likelihood[current] += np.log(totals[current])
+            alpha = np.where(totals[:, None] > 0, alpha / np.where(totals > 0, totals, 1)[:, None], alpha)
+        return log_likelihood, alpha
+
+    def tag_many(self, sequences):
+        paths = self.viterbi_batch([self.encode(sequence) for sequence in sequences])
+        return [None if path is None else [self.states[i] for i in path] for path in paths]
+
+    def tag(self, sequence, log_space=False, beam=None, threshold=None):
+        if not sequence:
+            return []
+        path, _ = self.viterbi(self.encode(sequence), log_space, beam, threshold)
+        if path is None:
+            return None
+        return [self.states[i] for i in path]
+
+_worker_model = None
+
+def _init_worker(source, profiling=False):
+    global _worker_model
+    # a forked worker starts with a copy of the parent's profiler; drop it so only the worker's own
+    # decoding is sent back, and leave the subscribers to the parent, which replays merged events
+    PROFILER.enabled = False
+    PROFILER.reset()
+    PROFILER.subscribers = []
+    if isinstance(source, str):
+        hmm = HMM()
+        hmm.load(source)
+        source = hmm.compile()
+    _worker_model = source
+    PROFILER.enabled = profiling
+
+def _tag_in_worker(sequence, **options):
+    tags = _worker_model.tag(sequence, **options)
+    return tags, PROFILER.snapshot() if PROFILER.enabled else None
+
+def _counts_in_worker(sequences, initial, trans_probs, emit):
+    return accumulate_counts(_worker_model.with_parameters(initial, trans_probs, emit), sequences)
+
+def accumulate_counts(model, sequences):
+    n = len(model.states)
+    initial = np.zeros(n)
+    trans = np.zeros(len(model.pred_src))
+    emit = np.zeros(model.emit.shape)
+    log_likelihood = 0.0
+    skipped = 0
+    for obs in sequences:
+        counts = model.expected_counts(obs)
+        if counts is None:
+            skipped += 1
+            continue
+        initial += counts[0]
+        trans += counts[1]
+        np.add.at(emit.T, obs, counts[2])
+        log_likelihood += counts[3]
+    # report transition counts per trans_probs entry, which stays aligned across re-estimated models
+    entry_counts = np.zeros(len(model.trans_probs))
+    entry_counts[model.pred_entries] = trans
+    return initial, entry_counts, emit, log_likelihood, skipped
+
+def normalize_rows(counts, fallback):
+    totals = counts.sum(axis=-1, keepdims=True)
+    return np.where(totals > 0, counts / np.where(totals > 0, totals, 1), fallback)
+
+def normalize_entries(model, counts, initial):
+    # per-entry transition counts normalised over their source state; '#' entries take the new initial
+    start = model.trans_rows < 0
+    rows = np.where(start, 0, model.trans_rows)
+    totals = np.bincount(rows[~start], weights=counts[~start], minlength=len(model.states))[rows]
+    probs = np.where(totals > 0, counts / np.where(totals > 0, totals, 1), model.trans_probs)
+    probs[start] = initial[model.trans_cols[start]]
+    return probs
+
+def tokenize(line):
+    return re.findall(r"\w+|[^\s\w]", line)
+
+def read_sentences(path):
+    with PROFILER.phase('tokenize'), open(path, 'r') as f:
+        sentences = [tokenize(line) for line in f if line.strip()]
+    if PROFILER.enabled:
+        PROFILER.count('tokenize.sentences', len(sentences))
+        PROFILER.count('tokenize.tokens', sum(len(sentence) for sentence in sentences))
+    return sentences
+
+def cache_is_fresh(basename):
+    cache_path = basename + CACHE_SUFFIX
+    try:
+        cache_time = os.path.getmtime(os.path.join(cache_path, 'states.txt'))
+        return all(os.path.getmtime(basename + ext) <= cache_time for ext in ('.trans', '.emit'))
+    except OSError:
+        return False
+
+def score_tags(predicted, reference):
+    correct = 0
+    total = 0
+    for tags, true_tags in zip(predicted, reference):
+        if tags is None or len(tags) != len(true_tags):
+            continue
+        correct += sum(p == t for p, t in zip(tags, true_tags))
+        total += len(tags)
+    return correct, total
+
+def read_tagged(path):
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    return [lines[i].split() for i in range(0, len(lines), 2) if lines[i].strip()]
+
+class SequenceSampler:
+    def __init__(self, model, seed=None):
+        self.model = model
+        self.rng = np.random.default_rng(seed)
+        self.state_names = np.array(model.states, dtype=object)
+        self.symbol_names = np.array(model.symbols, dtype=object)
+        # row 0 of the transition table is the '#' start row, row i + 1 is state i
+        self.trans_table = self._cumulative(model.trans_rows + 1, model.trans_cols, model.trans_probs, len(model.states) + 1)
+        emit_rows, emit_cols = np.nonzero(model.emit[:, :model.unknown])
+        self.emit_table = self._cumulative(emit_rows, emit_cols, model.emit[emit_rows, emit_cols], len(model.states))
+        self.trans_live = self.trans_table[2]
+        self.emit_live = self.emit_table[2]
+
+    @staticmethod
+    def _cumulative(rows, cols, probs, num_rows):
+        # positive entries grouped by row, so sparse models never need an N x N table
+        keep = probs > 0
+        order = np.lexsort((cols[keep], rows[keep]))
+        rows, cols, probs = rows[keep][order], cols[keep][order], probs[keep][order]
+        first = np.searchsorted(rows, np.arange(num_rows))
+        end = np.searchsorted(rows, np.arange(num_rows), side='right')
+        live = end > first
+        last = np.maximum(end - 1, first)
+        cumulative = np.cumsum(probs)
+        within = cumulative - np.concatenate(([0.0], cumulative))[first[rows]]
+        # offset each row by its index so one searchsorted serves every row at once
+        flat = within / within[last[rows]] + rows
+        return flat, cols.astype(np.intp), live, first, last
+
+    def _draw(self, table, rows):
+        cdf, cols, _, first, last = table
+        picks = np.searchsorted(cdf, rows + self.rng.random(len(rows)), side='right')
+        return cols[np.clip(picks, first[rows], last[rows])]
+
+    def sample_arrays(self, count, n):
+        states = np.zeros((count, n), dtype=np.intp)
+        symbols = np.zeros((count, n), dtype=np.intp)
+        lengths = np.zeros(count, dtype=np.intp)
+        active = np.arange(count)
+        rows = np.zeros(count, dtype=np.intp)
+
+        for t in range(n):
+            active = active[self.trans_live[rows]]
+            rows = rows[self.trans_live[rows]]
+            if not len(active):
+                break
+            current = self._draw(self.trans_table, rows)
+            keep = self.emit_live[current]
+            active, current = active[keep], current[keep]
+            if not len(active):
+                break
+            states[active, t] = current
+            symbols[active, t] = self._draw(self.emit_table, current)
+            lengths[active] = t + 1
+            rows = current + 1
+        return states, symbols, lengths
+
+    def sample(self, count, n):
+        states, symbols, lengths = self.sample_arrays(count, n)
+        return [Sequence(self.state_names[states[i, :k]].tolist(), self.symbol_names[symbols[i, :k]].tolist())
+                for i, k in enumerate(lengths)]
+
+    def stream(self, n, batch_size=1000, total=None):
+        produced = 0
+        while total is None or produced < total:
+            count = batch_size if total is None else min(batch_size, total - produced)
+            yield from self.sample(count, n)
+            produced += count
+
+class ForwardFilter:
+    def __init__(self, hmm, safe_zones=None):
+        self.model = hmm.compile()
+        if safe_zones is None and hmm.basename == 'lander':
+            safe_zones = LANDER_SAFE_ZONES
+        self.safe_zones = set(safe_zones) if safe_zones else None
+        self.reset()
+
+    def reset(self):
+        self.belief = None
+        self.log_likelihood = 0.0
+        self.steps = 0
+
+    def update(self, observation):
+        model = self.model
+        emit_column = model.emission_column(model.symbol_index.get(observation, model.unknown))
+        if self.belief is None:
+            alpha = model.initial * emit_column
+        else:
+            alpha = model.propagate(self.belief) * emit_column
+        self.steps += 1
+
+        total = alpha.sum()
+        if total == 0:
+            # the reading is impossible under the model; keep the previous belief
+            self.log_likelihood = -math.inf
+            return self.belief
+        self.belief = alpha / total
+        self.log_likelihood += math.log(total)
+        return self.belief
+
+    @property
+    def most_likely_state(self):
+        if self.belief is None:
+            return None
+        return self.model.states[int(self.belief.argmax())]
+
+    @property
+    def safe_to_land(self):
+        if self.safe_zones is None or self.belief is None:
+            return None
+        return self.most_likely_state in self.safe_zones
+
+class StreamingViterbi:
+    def __init__(self, hmm, lag=None):
+        if lag is not None and lag < 0:
+            raise ValueError(f"lag must be non-negative, got {lag}")
+        self.model = hmm.compile()
+        self.lag = lag
+        self.reset()
+
+    def reset(self):
+        self.delta = None
+        # which states' best paths still pass through every forced commit; None when they all do
+        self.consistent = None
+        # window[k] holds the backpointers from the (k + 1)-th pending observation to the k-th
+        self.window = deque()
+        # traced[k] holds the k-th pending observation's states that some surviving path still passes through
+        self.traced = deque()
+        self.pending = 0
+        self.steps = 0
+        self.committed = 0
+        self.forced = 0
+        self.failures = 0
+
+    def _commit(self, end, state):
+        # settle the pending observations 0..end, ending in `state`, and drop their backpointers
+        rows = [row for _, row in zip(range(end), self.window)]
+        path = [state]
+        for row in reversed(rows):
+            state = row[state]
+            path.append(state)
+        path.reverse()
+        for _ in range(min(end + 1, len(self.window))):
+            self.window.popleft()
+        for _ in range(min(end + 1, len(self.traced))):
+            self.traced.popleft()
+        self.pending -= end + 1
+        self.committed += end + 1
+        return [self.model.states[i] for i in path]
+
+    def _converged(self):
+        live = np.flatnonzero(self.delta != -np.inf)
+        if len(live) == 1:
+            return self._commit(self.pending - 1, live[0])
+        # follow every surviving path back until they all pass through one state; the sets only
+        # shrink from step to step, so once one matches the previous step's the rest are unchanged too
+        states = live
+        for offset, row in zip(range(self.pending - 2, -1, -1), reversed(self.window)):
+            states = np.unique(row[states])
+            if len(states) == 1:
+                return self._commit(offset, states[0])
+            if offset == len(self.traced):
+                self.traced.append(states)
+            elif len(self.traced[offset]) == len(states):
+                break
+            else:
+                self.traced[offset] = states
+        return []
+
+    def best_state(self):
+        # prefer paths that agree with what was already committed, but keep the others alive: if the
+        # committed guess turns out to be a dead end, decoding carries on along them instead of failing
+        if self.consistent is None:
+            return int(self.delta.argmax())
+        return int(np.where(self.consistent, self.delta, -np.inf).argmax())
+
+    def _force(self):
+        # commit the observations older than the lag along the current best path
+        end = self.pending - self.lag - 1
+        rows = list(self.window)[end:]
+        state = self.best_state()
+        ancestors = np.arange(len(self.delta))
+        for row in reversed(rows):
+            state = row[state]
+            ancestors = row[ancestors]
+        self.consistent = (ancestors == state) & (self.delta != -np.inf)
+        self.forced += 1
+        return self._commit(end, state)
+
+    def update(self, observation):
+        model = self.model
+        column = model.emission_column(model.symbol_index.get(observation, model.unknown), True)
+        self.steps += 1
+        if self.delta is None:
+            delta, best = model.log_tables()[0] + column, None
+        else:
+            delta, best = model.max_step(self.delta, column, True)
+
+        if (delta == -np.inf).all():
+            # no path explains this observation: settle what came before and start over after it
+            committed = self.flush()
+            self.failures += 1
+            self.committed += 1
+            return committed + [None]
+
+        if self.consistent is not None:
+            self.consistent = self.consistent[best] & (delta != -np.inf)
+            if not self.consistent.any():
+                self.consistent = None
+
+        if best is not None and self.pending:
+            self.window.append(best.astype(model.backptr_dtype))
+        # log scores only matter relative to each other; rebasing keeps them from drifting on endless input,
+        # and doing it rarely keeps tie-breaking identical to full Viterbi on ordinary lengths
+        top = delta.max()
+        self.delta = delta - top if top < -STREAM_REBASE else delta
+        self.pending += 1
+
+        committed = self._converged()
+        if self.lag is not None and self.pending > self.lag:
+            committed += self._force()
+        if PROFILER.enabled:
+            PROFILER.count('stream.observations')
+            PROFILER.maximum('stream.max_pending', self.pending)
+        return committed
+
+    def flush(self):
+        committed = self._commit(self.pending - 1, self.best_state()) if self.pending else []
+        self.delta = None
+        self.consistent = None
+        return committed
+
+    def decode(self, observations):
+        for observation in observations:
+            yield from self.update(observation)
+        yield from self.flush()
+
 class HMM:
     def __init__(self, transitions=None, emissions=None):
+        self.compiled = None
+        # True while self.compiled is exactly what sits in the on-disk cache for basename
+        self.cache_backed = False
         self.transitions = transitions if transitions else {}
         self.emissions = emissions if emissions else {}
         self.basename = ''
 
-    def load(self, basename):
+    # after a cached load the dicts are only rebuilt from the arrays when someone asks for them
+    @property
+    def transitions(self):
+        if self._transitions is None:
+            self._transitions, self._emissions = self.compiled.to_dicts()
+        return self._transitions
+
+    @transitions.setter
+    def transitions(self, value):
+        self._transitions = value
+        # None only marks the dicts as not yet rebuilt from the compiled arrays
+        if value is not None:
+            self.invalidate()
+
+    @property
+    def emissions(self):
+        if self._emissions is None:
+            self._transitions, self._emissions = self.compiled.to_dicts()
+        return self._emissions
+
+    @emissions.setter
+    def emissions(self, value):
+        self._emissions = value
+        # None only marks the dicts as not yet rebuilt from the compiled arrays
+        if value is not None:
+            self.invalidate()
+
+    def invalidate(self):
+        # assigning new dicts does this already; call it after editing their rows in place
+        self.compiled = None
+        self.cache_backed = False
+
+    def compile(self, refresh=False):
+        if refresh:
+            self.invalidate()
+        if self.compiled is None:
+            with PROFILER.phase('compile'):
+                self.compiled = CompiledHMM(self)
+            self.cache_backed = False
+        return self.compiled
+
+    def load(self, basename, use_cache=True):
+        self.basename = basename
+        self.compiled = None
+
+        if use_cache and cache_is_fresh(basename):
+            try:
+                with PROFILER.phase('load.cache'):
+                    self.compiled = CompiledHMM.open(basename + CACHE_SUFFIX)
+                self.cache_backed = True
+                self.transitions = None
+                self.emissions = None
+                return
+            except (OSError, ValueError):
+                self.compiled = None
+
         self.transitions = {}
         self.emissions = {}
-        self.basename = basename
+        start = time.perf_counter() if PROFILER.enabled else None
+        lines = 0
 
         with open(basename + '.trans', 'r') as trans_file:
             for line in trans_file:
+                lines += 1
                 line = line.strip()
                 if not line:
                     continue
@@ -51,6 +961,7 @@ class HMM:
 
         with open(basename + '.emit', 'r') as emit_file:
             for line in emit_file:
+                lines += 1
                 line = line.strip()
                 if not line or line.startswith('#'):
                     continue
@@ -60,6 +971,18 @@ class HMM:
                 state, emission, prob = parts
                 prob = float(prob)
                 self.emissions.setdefault(state, {})[emission] = prob
+        if start is not None:
+            PROFILER.add_time('load.parse', time.perf_counter() - start)
+            PROFILER.count('load.lines_parsed', lines)
+
+        self.compile()
+        if use_cache:
+            try:
+                with PROFILER.phase('load.cache_write'):
+                    self.compiled.save(basename + CACHE_SUFFIX)
+                self.cache_backed = True
+            except OSError:
+                pass
 
     def generate(self, n):
         states = []
@@ -87,23 +1010,72 @@ class HMM:
 
         return Sequence(states, emissions)
 
+    def save(self, basename):
+        with open(basename + '.trans', 'w') as trans_file:
+            for to_state, prob in self.transitions.get('#', {}).items():
+                trans_file.write(f"# {to_state} {prob!r}\n")
+            for from_state, successors in self.transitions.items():
+                if from_state == '#':
+                    continue
+                for to_state, prob in successors.items():
+                    trans_file.write(f"{from_state} {to_state} {prob!r}\n")
+
+        with open(basename + '.emit', 'w') as emit_file:
+            for state, emits in self.emissions.items():
+                for emission, prob in emits.items():
+                    emit_file.write(f"{state} {emission} {prob!r}\n")
+
+    def train(self, sequences, iterations=10, tolerance=1e-4, workers=1, smoothing=0.0):
+        sequences = [sequence for sequence in sequences if sequence]
+        if smoothing > 0:
+            # give words the model has never seen a foothold, or EM can never assign them mass
+            known = self.compile().symbol_index
+            unseen = sorted({symbol for sequence in sequences for symbol in sequence} - set(known))
+            if unseen:
+                for emits in self.emissions.values():
+                    for symbol in unseen:
+                        emits.setdefault(symbol, smoothing)
+                self.invalidate()
+
+        model = self.compile()
+        encoded = [model.encode(sequence) for sequence in sequences]
+        history = []
+        executor = None
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model,))
+            chunks = [encoded[i::workers * 4] for i in range(workers * 4)]
+
+        try:
+            for _ in range(iterations):
+                if executor is None:
+                    results = [accumulate_counts(model, encoded)]
+                else:
+                    task = partial(_counts_in_worker, initial=model.initial, trans_probs=model.trans_probs, emit=model.emit)
+                    results = list(executor.map(task, chunks))
+                initial, trans, emit, log_likelihood, skipped = [sum(r[i] for r in results) for i in range(5)]
+                history.append((float(log_likelihood), skipped))
+
+                emit[:, model.unknown] = 0
+                initial = normalize_rows(initial, model.initial)
+                model = model.with_parameters(initial, normalize_entries(model, trans, initial),
+                                              normalize_rows(emit, model.emit))
+                if len(history) > 1 and abs(history[-1][0] - history[-2][0]) < tolerance:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.transitions, self.emissions = model.to_dicts()
+        self.compiled = model
+        return history
+
+    def sampler(self, seed=None):
+        return SequenceSampler(self.compile(), seed)
+
     def forward(self, sequence):
-        states = list(self.emissions.keys())
-        alpha = [{}]
-        for state in states:
-            trans_prob = self.transitions['#'].get(state, 0)
-            emit_prob = self.emissions[state].get(sequence[0], 0)
-            alpha[0][state] = trans_prob * emit_prob
-
-        for t in range(1, len(sequence)):
-            alpha.append({})
-            for curr_state in states:
-                total = sum(alpha[t - 1][prev_state] * self.transitions[prev_state].get(curr_state, 0)
-                             for prev_state in states)
-                emit_prob = self.emissions[curr_state].get(sequence[t], 0)
-                alpha[t][curr_state] = total * emit_prob
-
-        final_probs = alpha[-1]
+        model = self.compile()
+        alpha = model.forward(model.encode(sequence))
+        final_probs = dict(zip(model.states, alpha.tolist()))
         total_prob = sum(final_probs.values())
         print(f"Total probability of the observation sequence: {total_prob}")
 
@@ -114,96 +1086,130 @@ class HMM:
             print("No valid final states found.")
 
         if self.basename == 'lander':
-            safe_zones = ['2,2', '3,3', '4,4']
-            if most_probable_state in safe_zones:
+            if most_probable_state in LANDER_SAFE_ZONES:
                 print("Safe to land.")
             else:
                 print("Not safe to land.")
 
-    def viterbi(self, sequence, true_states=None):
-        states = list(self.emissions.keys())
-        V = [{}]
-        path = {}
-
-        for state in states:
-            trans_prob = self.transitions['#'].get(state, 0)
-            emit_prob = self.emissions[state].get(sequence[0], 0)
-            V[0][state] = trans_prob * emit_prob
-            path[state] = [state]
-
-        for t in range(1, len(sequence)):
-            V.append({})
-            new_path = {}
-
-            for curr_state in states:
-                max_prob = 0
-                prev_st_selected = None
-                for prev_state in states:
-                    prev_prob = V[t - 1].get(prev_state, 0)
-                    if prev_prob == 0:
-                        continue
-
-                    trans_p = self.transitions[prev_state].get(curr_state, 0)
-                    emit_p = self.emissions[curr_state].get(sequence[t], 0)
-
-                    if trans_p == 0 or emit_p == 0:
-                        continue
-
-                    prob = prev_prob * trans_p * emit_p
-
-                    if prob > max_prob:
-                        max_prob = prob
-                        prev_st_selected = prev_state
+    def viterbi(self, sequence, true_states=None, log_space=False, beam=None, threshold=None):
+        model = self.compile()
+        best_path, failed_at = model.viterbi(model.encode(sequence), log_space, beam, threshold)
+        if best_path is None:
+            print(f"No valid paths at time {failed_at}")
+            return
 
-                if max_prob > 0:
-                    V[t][curr_state] = max_prob
-                    new_path[curr_state] = path[prev_st_selected] + [curr_state]
-
-            if not V[t]:
-                print(f"No valid paths at time {t}")
-                return
-
-            path = new_path
-
-        n = len(sequence) - 1
-        max_prob = max(V[n].values())
-        possible_states = [state for state in V[n] if V[n][state] == max_prob]
-        state = possible_states[0]
+        path = [model.states[i] for i in best_path]
         print('Most probable state sequence:')
-        print(' '.join(path[state]))
+        print(' '.join(path))
 
         if true_states:
-            if len(true_states) != len(path[state]):
+            if len(true_states) != len(path):
                 print("Warning: The length of true states and predicted states does not match.")
                 print(f"Length of observation sequence: {len(sequence)}")
-                print(f"Length of predicted states: {len(path[state])}")
+                print(f"Length of predicted states: {len(path)}")
                 print(f"Length of true states sequence: {len(true_states)}")
             else:
-                correct = sum(p == t for p, t in zip(path[state], true_states))
+                correct = sum(p == t for p, t in zip(path, true_states))
                 accuracy = correct / len(true_states)
                 print(f"Accuracy: {accuracy * 100:.2f}%")
 
+        if beam is not None or threshold is not None:
+            exact = model.tag(sequence, log_space)
+            correct, total = score_tags([path], [exact])
+            if total:
+                print(f"Agreement with exact Viterbi: {correct / total * 100:.2f}%")
+            else:
+                print("Exact Viterbi found a different path length or no path.")
+
+    def tag_batch(self, sentences, workers=1, log_space=False, chunksize=None, beam=None, threshold=None):
+        model = self.compile()
+        options = {'log_space': log_space, 'beam': beam, 'threshold': threshold}
+        if workers <= 1:
+            return [model.tag(sentence, **options) for sentence in sentences]
+
+        sentences = list(sentences)
+        if chunksize is None:
+            chunksize = max(1, len(sentences) // (workers * 4))
+        # workers map a fresh on-disk cache themselves instead of unpickling a private copy
+        fresh = self.cache_backed and self.basename and cache_is_fresh(self.basename)
+        source = self.basename if fresh else model
+        initargs = (source, PROFILER.enabled)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+            results = list(executor.map(partial(_tag_in_worker, **options), sentences, chunksize=chunksize))
+        # the decoding itself was profiled in the workers; fold their counters into this process's report
+        for _, recorded in results:
+            if recorded is not None:
+                PROFILER.merge(recorded)
+        return [tags for tags, _ in results]
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected an integer >= 1, got {value}")
+    return number
+
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"expected an integer >= 0, got {value}")
+    return number
+
+def unit_fraction(value):
+    number = float(value)
+    if not 0 < number <= 1:
+        raise argparse.ArgumentTypeError(f"expected a fraction in (0, 1], got {value}")
+    return number
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='HMM Tool')
     parser.add_argument('basename', help='Base name of the HMM files')
     parser.add_argument('--generate', type=int, help='Generate a sequence of given length')
     parser.add_argument('--generate_only_obs', action='store_true', help='Generate only the observation sequence')
+    parser.add_argument('--count', type=int, default=1, help='Number of sequences to generate')
+    parser.add_argument('--seed', type=int, help='Random seed for generation')
     parser.add_argument('--forward', type=str, help='Perform forward algorithm on given sequence file')
+    parser.add_argument('--filter', type=str, help="Run the online forward filter over a sequence file ('-' for stdin)")
     parser.add_argument('--viterbi', type=str, help='Perform Viterbi algorithm on given sequence file')
+    parser.add_argument('--stream', type=str, help="Decode a sequence file ('-' for stdin) with the streaming Viterbi decoder")
+    parser.add_argument('--lag', type=non_negative_int, help='With --stream, commit each state at most this many observations late')
+    parser.add_argument('--log_space', action='store_true', help='Score Viterbi in log space to avoid underflow on long sequences')
+    parser.add_argument('--batch', action='store_true', help='With --viterbi, tag each line of the file as its own sentence')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes for --batch tagging')
+    parser.add_argument('--train', type=str, help='Re-estimate the model with Baum-Welch on a file of observation sequences')
+    parser.add_argument('--iterations', type=int, default=10, help='Maximum number of Baum-Welch iterations')
+    parser.add_argument('--smoothing', type=float, default=0.0, help='Initial emission probability given to words unseen by the model')
+    parser.add_argument('--output', type=str, help='Base name for the trained .trans/.emit files')
+    parser.add_argument('--profile', nargs='?', const='-', help='Record per-phase timings and counters as JSON (to stderr, or the given file)')
+    parser.add_argument('--beam', type=positive_int, help='Keep only the top K states per step when running Viterbi')
+    parser.add_argument('--beam_threshold', type=unit_fraction, help='Drop Viterbi states scoring below this fraction of the best one')
     args = parser.parse_args()
 
+    if args.profile:
+        PROFILER.enabled = True
+
     h = HMM()
     h.load(args.basename)
 
-    if args.generate:
-        seq = h.generate(args.generate)
-        if args.generate_only_obs:
-            print(' '.join(seq.outputseq))
+    if args.train:
+        if os.path.exists(args.train):
+            history = h.train(read_sentences(args.train), args.iterations, workers=args.workers, smoothing=args.smoothing)
+            for i, (log_likelihood, skipped) in enumerate(history):
+                print(f"Iteration {i + 1}: log-likelihood {log_likelihood:.4f}, {skipped} sequences skipped")
+            output = args.output if args.output else args.basename + '_trained'
+            h.save(output)
+            print(f"Wrote {output}.trans and {output}.emit")
         else:
-            print('Generated States:')
-            print(' '.join(seq.stateseq))
-            print('Generated Emissions:')
-            print(' '.join(seq.outputseq))
+            print(f"Training file {args.train} not found.")
+
+    if args.generate:
+        for seq in h.sampler(args.seed).stream(args.generate, total=args.count):
+            if args.generate_only_obs:
+                print(' '.join(seq.outputseq))
+            else:
+                print('Generated States:')
+                print(' '.join(seq.stateseq))
+                print('Generated Emissions:')
+                print(' '.join(seq.outputseq))
 
     if args.forward:
         if os.path.exists(args.forward):
@@ -218,30 +1224,93 @@ if __name__ == "__main__":
         else:
             print(f"Observation file {args.forward} not found.")
 
-    if args.viterbi:
+    if args.filter:
+        if args.filter == '-' or os.path.exists(args.filter):
+            stream = sys.stdin if args.filter == '-' else open(args.filter, 'r')
+            tracker = ForwardFilter(h)
+            with stream:
+                for line in stream:
+                    for observation in line.split():
+                        tracker.update(observation)
+                        status = f"{tracker.steps} {observation} {tracker.most_likely_state}"
+                        if tracker.safe_to_land is not None:
+                            status += " safe" if tracker.safe_to_land else " not safe"
+                        print(status, flush=True)
+        else:
+            print(f"Observation file {args.filter} not found.")
+
+    if args.stream:
+        if args.stream == '-' or os.path.exists(args.stream):
+            stream = sys.stdin if args.stream == '-' else open(args.stream, 'r')
+            decoder = StreamingViterbi(h, args.lag)
+            start = time.perf_counter()
+            with stream:
+                observations = (observation for line in stream for observation in line.split())
+                for i, state in enumerate(decoder.decode(observations)):
+                    print(f"{i + 1} {state if state is not None else '-'}", flush=True)
+            seconds = time.perf_counter() - start
+            print(f"Decoded {decoder.steps} observations in {seconds:.3f}s "
+                  f"({decoder.steps / seconds if seconds else 0:.0f} obs/s), {decoder.forced} forced commits, "
+                  f"{decoder.failures} impossible observations", file=sys.stderr)
+        else:
+            print(f"Observation file {args.stream} not found.")
+
+    if args.viterbi and args.batch:
         if os.path.exists(args.viterbi):
-            with open(args.viterbi, 'r') as f:
-                sequence = []
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    tokens = re.findall(r"\w+|[^\s\w]", line)
-                    sequence.extend(tokens)
+            sentences = read_sentences(args.viterbi)
+            tagged_file = args.viterbi.replace('.obs', '.tagged.obs')
+            true_tags = read_tagged(tagged_file) if os.path.exists(tagged_file) else None
+
+            results = h.tag_batch(sentences, args.workers, args.log_space, beam=args.beam, threshold=args.beam_threshold)
+            for i, tags in enumerate(results):
+                if tags is None:
+                    print(f"Sentence {i + 1}: no valid path")
+                    continue
+                print(' '.join(tags))
+                if true_tags is not None and i < len(true_tags) and len(tags) != len(true_tags[i]):
+                    print(f"Warning: sentence {i + 1} has {len(tags)} predicted and {len(true_tags[i])} true tags.")
+
+            if true_tags is not None:
+                correct, total = score_tags(results, true_tags)
+                if total:
+                    print(f"Accuracy: {correct / total * 100:.2f}%")
+
+            if args.beam is not None or args.beam_threshold is not None:
+                exact = h.tag_batch(sentences, args.workers, args.log_space)
+                correct, total = score_tags(results, exact)
+                if total:
+                    print(f"Agreement with exact Viterbi: {correct / total * 100:.2f}%")
+                if true_tags is not None:
+                    exact_correct, exact_total = score_tags(exact, true_tags)
+                    if exact_total:
+                        print(f"Exact Viterbi accuracy: {exact_correct / exact_total * 100:.2f}%")
+        else:
+            print(f"Observation file {args.viterbi} not found.")
+
+    elif args.viterbi:
+        if os.path.exists(args.viterbi):
+            sequence = []
+            for tokens in read_sentences(args.viterbi):
+                sequence.extend(tokens)
 
             tagged_file = args.viterbi.replace('.obs', '.tagged.obs')
             true_states = []
             if os.path.exists(tagged_file):
-                with open(tagged_file, 'r') as f_tagged:
-                    lines = f_tagged.readlines()
-                    for i in range(0, len(lines), 2):
-                        line = lines[i].strip()
-                        if not line:
-                            continue
-                        true_states.extend(line.split())
+                for tags in read_tagged(tagged_file):
+                    true_states.extend(tags)
             else:
                 true_states = None
 
-            h.viterbi(sequence, true_states)
+            h.viterbi(sequence, true_states, args.log_space, args.beam, args.beam_threshold)
         else:
             print(f"Observation file {args.viterbi} not found.")
+
+    if args.profile:
+        report = PROFILER.report()
+        report['emission_cache'] = h.compile().cache_info()
+        report = json.dumps(report, indent=2)
+        if args.profile == '-':
+            print(report, file=sys.stderr)
+        else:
+            with open(args.profile, 'w') as f:
+                f.write(report + '\n')
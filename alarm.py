@@ -1,6 +1,6 @@
 from pgmpy.models import BayesianNetwork
-from pgmpy.inference import VariableElimination
 from pgmpy.factors.discrete import TabularCPD
+from inference import CachedInference
 
 class AlarmModel:
     def __init__(self):
@@ -13,6 +13,22 @@ class AlarmModel:
             ]
         )
         self._define_parameters()
+        self.inference = CachedInference(self.model)
+
+    def query(self, variables, evidence=None):
+        return self.inference.query(variables, evidence)
+
+    def batch_query(self, variables, evidence_rows):
+        return self.inference.batch_query(variables, evidence_rows)
+
+    def approximate_query(self, variables, evidence=None, **options):
+        return self.inference.approximate_query(variables, evidence, **options)
+
+    def marginals(self, evidence=None):
+        return self.inference.marginals(evidence)
+
+    def cache_info(self):
+        return self.inference.cache_info()
 
     def _define_parameters(self):
         self.cpd_burglary = TabularCPD(
@@ -65,29 +81,27 @@ class AlarmModel:
         )
 
     def perform_inference(self):
-        alarm_infer = VariableElimination(self.model)
-
         print("Query 1:")
-        result = alarm_infer.query(variables=["JohnCalls"], evidence={"Earthquake": "yes"})
+        result = self.query(variables=["JohnCalls"], evidence={"Earthquake": "yes"})
         print(result)
 
         print("\nQuery 2:")
-        result = alarm_infer.query(variables=["JohnCalls", "Earthquake"], evidence={"Burglary": "yes", "MaryCalls": "yes"})
+        result = self.query(variables=["JohnCalls", "Earthquake"], evidence={"Burglary": "yes", "MaryCalls": "yes"})
         print(result)
 
-        self._additional_queries(alarm_infer)
+        self._additional_queries()
 
-    def _additional_queries(self, infer):
+    def _additional_queries(self):
         print("\nQuery 3:")
-        result = infer.query(variables=['MaryCalls'], evidence={'JohnCalls': 'yes'})
+        result = self.query(variables=['MaryCalls'], evidence={'JohnCalls': 'yes'})
         print(result)
 
         print("\nQuery 4:")
-        result = infer.query(variables=['JohnCalls', 'MaryCalls'], evidence={'Alarm': 'yes'})
+        result = self.query(variables=['JohnCalls', 'MaryCalls'], evidence={'Alarm': 'yes'})
         print(result)
 
         print("\nQuery 5:")
-        result = infer.query(variables=['Alarm'], evidence={'MaryCalls': 'yes'})
+        result = self.query(variables=['Alarm'], evidence={'MaryCalls': 'yes'})
         print(result)
 
 def main():
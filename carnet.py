@@ -1,6 +1,6 @@
 from pgmpy.models import BayesianNetwork
-from pgmpy.inference import VariableElimination
 from pgmpy.factors.discrete import TabularCPD
+from inference import CachedInference
 
 class CarModel:
     def __init__(self):
@@ -15,6 +15,22 @@ class CarModel:
             ]
         )
         self._define_parameters()
+        self.inference = CachedInference(self.model)
+
+    def query(self, variables, evidence=None):
+        return self.inference.query(variables, evidence)
+
+    def batch_query(self, variables, evidence_rows):
+        return self.inference.batch_query(variables, evidence_rows)
+
+    def approximate_query(self, variables, evidence=None, **options):
+        return self.inference.approximate_query(variables, evidence, **options)
+
+    def marginals(self, evidence=None):
+        return self.inference.marginals(evidence)
+
+    def cache_info(self):
+        return self.inference.cache_info()
 
     def _define_parameters(self):
         self.cpd_battery = TabularCPD(
@@ -91,34 +107,32 @@ class CarModel:
         )
 
     def perform_inference(self):
-        car_infer = VariableElimination(self.model)
-
         print("Query 1:")
-        result = car_infer.query(variables=['Battery'], evidence={'Moves': 'no'})
+        result = self.query(variables=['Battery'], evidence={'Moves': 'no'})
         print(result)
 
         print("\nQuery 2:")
-        result = car_infer.query(variables=['Starts'], evidence={'Radio': "Doesn't turn on"})
+        result = self.query(variables=['Starts'], evidence={'Radio': "Doesn't turn on"})
         print(result)
 
         print("\nQuery 3:")
-        result1 = car_infer.query(variables=['Radio'], evidence={'Battery': 'Works'})
-        result2 = car_infer.query(variables=['Radio'], evidence={'Battery': 'Works', 'Gas': 'Full'})
+        result1 = self.query(variables=['Radio'], evidence={'Battery': 'Works'})
+        result2 = self.query(variables=['Radio'], evidence={'Battery': 'Works', 'Gas': 'Full'})
         print("P(Radio | Battery='Works'):\n", result1)
         print("\nP(Radio | Battery='Works', Gas='Full'):\n", result2)
 
         print("\nQuery 4:")
-        result1 = car_infer.query(variables=['Ignition'], evidence={'Moves': 'no'})
-        result2 = car_infer.query(variables=['Ignition'], evidence={'Moves': 'no', 'Gas': 'Empty'})
+        result1 = self.query(variables=['Ignition'], evidence={'Moves': 'no'})
+        result2 = self.query(variables=['Ignition'], evidence={'Moves': 'no', 'Gas': 'Empty'})
         print("P(Ignition | Moves='no'):\n", result1)
         print("\nP(Ignition | Moves='no', Gas='Empty'):\n", result2)
 
         print("\nQuery 5:")
-        result = car_infer.query(variables=['Starts'], evidence={'Radio': 'turns on', 'Gas': 'Full'})
+        result = self.query(variables=['Starts'], evidence={'Radio': 'turns on', 'Gas': 'Full'})
         print(result)
 
         print("\nQuery 6:")
-        result = car_infer.query(variables=['KeyPresent'], evidence={'Moves': 'no'})
+        result = self.query(variables=['KeyPresent'], evidence={'Moves': 'no'})
         print("P(KeyPresent | Moves='no'):\n", result)
 
 def main():
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from HMM import HMM, StreamingViterbi
+
+SHIPPED_MODELS = ['cat', 'lander', 'partofspeech']
+STREAM_LAGS = [None, 4, 16]
+
+def synthetic_hmm(num_states, density, vocab_size, seed=0):
+    rng = np.random.default_rng(seed)
+    states = [f"s{i}" for i in range(num_states)]
+    symbols = [f"w{i}" for i in range(vocab_size)]
+    successors = max(1, int(round(density * num_states)))
+    emits_per_state = max(1, min(vocab_size, vocab_size // 4))
+
+    transitions = {'#': dict(zip(states, (np.ones(num_states) / num_states).tolist()))}
+    emissions = {}
+    for state in states:
+        targets = rng.choice(num_states, size=successors, replace=False)
+        weights = rng.random(successors)
+        transitions[state] = {states[j]: p for j, p in zip(targets.tolist(), (weights / weights.sum()).tolist())}
+        outputs = rng.choice(vocab_size, size=emits_per_state, replace=False)
+        weights = rng.random(emits_per_state)
+        emissions[state] = {symbols[j]: p for j, p in zip(outputs.tolist(), (weights / weights.sum()).tolist())}
+    return HMM(transitions, emissions)
+
+def measure(fn, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    # peak memory comes from a separate traced run so tracing does not skew the timings
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def record(results, model, operation, variant, length, seconds, peak, items):
+    results.append({
+        'model': model,
+        'operation': operation,
+        'variant': variant,
+        'length': length,
+        'seconds': seconds,
+        'throughput': items / seconds if seconds > 0 else None,
+        'peak_bytes': peak,
+    })
+
+def bench_load(results, name, basename, repeats):
+    for variant, use_cache in (('text', False), ('cache', True)):
+        if use_cache:
+            HMM().load(basename)
+        seconds, peak = measure(lambda: HMM().load(basename, use_cache=use_cache), repeats)
+        record(results, name, 'load', variant, None, seconds, peak, 1)
+
+def bench_model(results, name, hmm, lengths, repeats):
+    model = hmm.compile()
+    sampler = hmm.sampler(0)
+    viterbi_variants = {
+        'linear': {},
+        'log': {'log_space': True},
+        'beam4': {'log_space': True, 'beam': 4},
+    }
+    if len(model.pred_src):
+        engines = {'dense': model.with_engine(False), 'sparse': model.with_engine(True)}
+    else:
+        engines = {'dense': model}
+
+    for length in lengths:
+        symbols = sampler.sample(1, length)[0].outputseq
+        obs = model.encode(symbols)
+        if not len(obs):
+            continue
+        for engine, engine_model in engines.items():
+            seconds, peak = measure(lambda: engine_model.forward(obs), repeats)
+            record(results, name, 'forward', engine, len(obs), seconds, peak, len(obs))
+            exact, _ = engine_model.viterbi(obs, log_space=True)
+            for variant, options in viterbi_variants.items():
+                seconds, peak = measure(lambda: engine_model.viterbi(obs, **options), repeats)
+                record(results, name, 'viterbi', f"{engine}-{variant}", len(obs), seconds, peak, len(obs))
+                path, _ = engine_model.viterbi(obs, **options)
+                if exact is not None and path is not None:
+                    results[-1]['agreement'] = float((path == exact).mean())
+
+        exact = model.tag(symbols, log_space=True)
+        for lag in STREAM_LAGS:
+            variant = 'stream' if lag is None else f"stream-lag{lag}"
+            # the decoder is built once, so only reset() and decoding are timed, not compiling the model
+            decoder = StreamingViterbi(hmm, lag)
+            decode = lambda: (decoder.reset(), list(decoder.decode(symbols)))[1]
+            seconds, peak = measure(decode, repeats)
+            record(results, name, 'viterbi', variant, len(obs), seconds, peak, len(obs))
+            if exact is not None:
+                decoded = decode()
+                results[-1]['agreement'] = float(np.mean([a == b for a, b in zip(decoded, exact)]))
+
+        seconds, peak = measure(lambda: hmm.generate(length), repeats)
+        record(results, name, 'generate', 'dict', length, seconds, peak, length)
+        seconds, peak = measure(lambda: sampler.sample_arrays(100, length), repeats)
+        record(results, name, 'generate', 'sampler-x100', length, seconds, peak, 100 * length)
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['results']
+    key = lambda r: (r['model'], r['operation'], r['variant'], r['length'])
+    previous = {key(r): r for r in baseline}
+    print(f"{'model':<24}{'operation':<10}{'variant':<20}{'length':>8}{'before':>12}{'after':>12}{'ratio':>8}")
+    for r in results:
+        old = previous.get(key(r))
+        if old is None:
+            continue
+        ratio = r['seconds'] / old['seconds'] if old['seconds'] else float('nan')
+        print(f"{r['model']:<24}{r['operation']:<10}{r['variant']:<20}{str(r['length']):>8}"
+              f"{old['seconds']:>12.6f}{r['seconds']:>12.6f}{ratio:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='HMM benchmark suite')
+    parser.add_argument('--output', default='hmm_benchmark.json', help='Where to write the JSON results')
+    parser.add_argument('--compare', type=str, help='Earlier results file to compare against')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000], help='Sequence lengths to sweep')
+    parser.add_argument('--states', type=int, nargs='+', default=[10, 100, 500], help='Synthetic state counts')
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.05, 1.0], help='Synthetic transition densities')
+    parser.add_argument('--vocab', type=int, nargs='+', default=[100, 10000], help='Synthetic vocabulary sizes')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed repeats per measurement (best is kept)')
+    parser.add_argument('--skip_synthetic', action='store_true', help='Only benchmark the shipped models')
+    args = parser.parse_args()
+
+    results = []
+    for name in SHIPPED_MODELS:
+        bench_load(results, name, name, args.repeats)
+        hmm = HMM()
+        hmm.load(name)
+        bench_model(results, name, hmm, args.lengths, args.repeats)
+        print(f"Finished {name}")
+
+    if not args.skip_synthetic:
+        with tempfile.TemporaryDirectory() as workdir:
+            for num_states in args.states:
+                for density in args.densities:
+                    for vocab_size in args.vocab:
+                        name = f"synthetic-n{num_states}-d{density}-v{vocab_size}"
+                        hmm = synthetic_hmm(num_states, density, vocab_size)
+                        basename = os.path.join(workdir, name)
+                        hmm.save(basename)
+                        bench_load(results, name, basename, args.repeats)
+                        bench_model(results, name, hmm, args.lengths, args.repeats)
+                        print(f"Finished {name}")
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} measurements to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
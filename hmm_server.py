@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from HMM import HMM, tokenize
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+MAX_GENERATE_LENGTH = 10000
+MAX_GENERATE_COUNT = 1000
+# most length * count cells sampled in one go; a request at both limits still runs, but alone
+MAX_GENERATE_CELLS = MAX_GENERATE_LENGTH * MAX_GENERATE_COUNT
+MAX_OBSERVATIONS = 10000
+MAX_BODY_BYTES = 1 << 20
+
+class Overloaded(Exception):
+    pass
+
+class Metrics:
+    def __init__(self, window=10000):
+        self.started = time.monotonic()
+        self.requests = {}
+        self.rejected = {}
+        self.batches = {}
+        self.batched_items = {}
+        self.latencies = {}
+        self.window = window
+
+    def observe(self, op, seconds):
+        self.requests[op] = self.requests.get(op, 0) + 1
+        self.latencies.setdefault(op, deque(maxlen=self.window)).append(seconds)
+
+    def reject(self, op):
+        self.rejected[op] = self.rejected.get(op, 0) + 1
+
+    def batch(self, op, size):
+        self.batches[op] = self.batches.get(op, 0) + 1
+        self.batched_items[op] = self.batched_items.get(op, 0) + size
+
+    def snapshot(self):
+        uptime = time.monotonic() - self.started
+        ops = {}
+        for op, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+            ops[op] = {
+                'requests': self.requests[op],
+                'rejected': self.rejected.get(op, 0),
+                'throughput_per_s': self.requests[op] / uptime if uptime else 0.0,
+                'mean_batch_size': self.batched_items.get(op, 0) / max(self.batches.get(op, 0), 1),
+                'latency_ms': {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': ordered[-1] * 1000},
+            }
+        return {'uptime_s': uptime, 'operations': ops}
+
+def length_class(item):
+    # requests within a factor of two in length share a batch, so padding never costs more than double
+    return len(item).bit_length()
+
+def generate_cells(item):
+    length, count = item
+    return length * count
+
+class MicroBatcher:
+    def __init__(self, name, handler, metrics, window, max_batch, max_queue, key=None, cost=None, max_cost=None):
+        self.name = name
+        self.handler = handler
+        self.key = key
+        self.cost = cost
+        self.max_cost = max_cost
+        self.metrics = metrics
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            self.metrics.reject(self.name)
+            raise Overloaded(f"{self.name} queue is full")
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # shorter groups go first and are answered before the longer ones start
+            for group in self.split(batch):
+                await self.process(group)
+
+    def split(self, batch):
+        groups = [batch]
+        if self.key is not None:
+            by_key = {}
+            for entry in batch:
+                by_key.setdefault(self.key(entry[0]), []).append(entry)
+            groups = [by_key[key] for key in sorted(by_key)]
+        if self.cost is None:
+            return groups
+
+        # then cut each group so its items' total cost stays within max_cost
+        chunks = []
+        for group in groups:
+            chunk, total = [], 0
+            for entry in group:
+                cost = self.cost(entry[0])
+                if chunk and total + cost > self.max_cost:
+                    chunks.append(chunk)
+                    chunk, total = [], 0
+                chunk.append(entry)
+                total += cost
+            chunks.append(chunk)
+        return chunks
+
+    async def process(self, batch):
+        loop = asyncio.get_running_loop()
+        self.metrics.batch(self.name, len(batch))
+        items = [item for item, _ in batch]
+        try:
+            results = await loop.run_in_executor(None, self.handler, items)
+        except Exception:
+            # retry one by one so a single bad item only fails its own request
+            results = await loop.run_in_executor(None, self.handle_each, items)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def handle_each(self, items):
+        results = []
+        for item in items:
+            try:
+                results.extend(self.handler([item]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+class ModelService:
+    def __init__(self, basename, metrics, window, max_batch, max_queue):
+        self.hmm = HMM()
+        self.hmm.load(basename)
+        self.model = self.hmm.compile()
+        self.sampler = self.hmm.sampler()
+        self.batchers = {
+            'tag': MicroBatcher('tag', self.tag, metrics, window, max_batch, max_queue, length_class),
+            'forward': MicroBatcher('forward', self.forward, metrics, window, max_batch, max_queue, length_class),
+            'generate': MicroBatcher('generate', self.generate, metrics, window, max_batch, max_queue,
+                                     cost=generate_cells, max_cost=MAX_GENERATE_CELLS),
+        }
+
+    def start(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+
+    def tag(self, items):
+        return [{'tags': tags} for tags in self.model.tag_many(items)]
+
+    def forward(self, items):
+        log_likelihood, belief = self.model.forward_batch([self.model.encode(item) for item in items])
+        results = []
+        for score, final in zip(log_likelihood.tolist(), belief):
+            if score == -math.inf:
+                results.append({'log_probability': None, 'probability': 0.0})
+                continue
+            result = {'log_probability': score, 'probability': math.exp(score)}
+            result['most_probable_state'] = self.model.states[int(final.argmax())]
+            results.append(result)
+        return results
+
+    def generate(self, items):
+        results = [None] * len(items)
+        by_length = {}
+        for i, (length, count) in enumerate(items):
+            by_length.setdefault(length, []).append((i, count))
+        for length, requests in by_length.items():
+            sequences = self.sampler.sample(sum(count for _, count in requests), length)
+            offset = 0
+            for i, count in requests:
+                chunk = sequences[offset:offset + count]
+                results[i] = {'sequences': [{'states': s.stateseq, 'observations': s.outputseq} for s in chunk]}
+                offset += count
+        return results
+
+class HMMServer:
+    def __init__(self, basenames, window=0.005, max_batch=64, max_queue=1024):
+        self.metrics = Metrics()
+        self.services = {name: ModelService(name, self.metrics, window, max_batch, max_queue) for name in basenames}
+
+    def start(self):
+        for service in self.services.values():
+            service.start()
+
+    async def dispatch(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok', 'models': list(self.services)}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics.snapshot()
+        if method != 'POST' or path not in ('/tag', '/forward', '/generate'):
+            return 404, {'error': f"no route for {method} {path}"}
+
+        try:
+            request = json.loads(body or b'{}')
+            service = self.services[request['model']]
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': 'expected a JSON body with a known "model"'}
+
+        op = path[1:]
+        try:
+            if op == 'generate':
+                item = (int(request.get('length', 10)), int(request.get('count', 1)))
+                if not (0 <= item[0] <= MAX_GENERATE_LENGTH and 0 <= item[1] <= MAX_GENERATE_COUNT):
+                    return 400, {'error': f"expected 0 <= length <= {MAX_GENERATE_LENGTH} and 0 <= count <= {MAX_GENERATE_COUNT}"}
+            elif 'observations' in request:
+                item = [str(observation) for observation in request['observations']]
+            elif 'sentence' in request:
+                item = tokenize(str(request['sentence']))
+            else:
+                return 400, {'error': 'expected "observations" or "sentence"'}
+        except (ValueError, TypeError, OverflowError):
+            return 400, {'error': 'malformed request fields'}
+        if op != 'generate' and not 0 < len(item) <= MAX_OBSERVATIONS:
+            return 400, {'error': f"expected between 1 and {MAX_OBSERVATIONS} observations"}
+
+        start = time.perf_counter()
+        try:
+            result = await service.batchers[op].submit(item)
+        except Overloaded as e:
+            return 503, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': f"{type(e).__name__}: {e}"}
+        self.metrics.observe(op, time.perf_counter() - start)
+        return 200, result
+
+    async def respond(self, writer, status, payload):
+        data = json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) < 2:
+                    break
+                method, path = parts[0], parts[1]
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                length = headers.get('content-length', '0')
+                if not length.isdigit():
+                    # without a usable length the body cannot be skipped, so the connection ends here
+                    await self.respond(writer, 400, {'error': 'invalid Content-Length'})
+                    break
+                if int(length) > MAX_BODY_BYTES:
+                    # the oversized body is left unread, so the connection cannot carry another request
+                    await self.respond(writer, 413, {'error': f"request body is larger than {MAX_BODY_BYTES} bytes"})
+                    break
+                body = await reader.readexactly(int(length))
+
+                status, payload = await self.dispatch(method, path, body)
+                await self.respond(writer, status, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(args):
+    server = HMMServer(args.models, args.batch_window / 1000, args.max_batch, args.max_queue)
+    server.start()
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix)
+        print(f"Serving {', '.join(args.models)} on unix socket {args.unix}", flush=True)
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        print(f"Serving {', '.join(args.models)} on http://{args.host}:{args.port}", flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Long-running HMM tagging and decoding service')
+    parser.add_argument('models', nargs='+', help='Base names of the HMM files to keep loaded')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to listen on')
+    parser.add_argument('--unix', type=str, help='Listen on this Unix socket path instead of TCP')
+    parser.add_argument('--batch_window', type=float, default=5.0, help='Milliseconds to wait while filling a batch')
+    parser.add_argument('--max_batch', type=int, default=64, help='Largest number of requests decoded together')
+    parser.add_argument('--max_queue', type=int, default=1024, help='Pending requests per operation before rejecting with 503')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import networkx as nx
+import numpy as np
+import pandas as pd
+from pgmpy.factors.discrete import DiscreteFactor
+from pgmpy.inference import VariableElimination
+
+Z_95 = 1.959963984540054
+
+def contract(operands, output):
+    # einsum accepts at most 52 distinct subscripts per call, so number the variables afresh each time
+    ids = {}
+    args = []
+    for array, scope in operands:
+        args += [array, [ids.setdefault(v, len(ids)) for v in scope]]
+    return np.einsum(*args, [ids[v] for v in output])
+
+class CompiledNetwork:
+    def __init__(self, model):
+        self.variables = list(model.nodes())
+        self.state_names = {var: list(model.get_cpds(var).state_names[var]) for var in self.variables}
+        self.state_index = {var: {state: i for i, state in enumerate(states)} for var, states in self.state_names.items()}
+        self.factors = []
+        for cpd in model.get_cpds():
+            values = np.asarray(cpd.values, dtype=float)
+            # line every axis up with the canonical state order of its variable
+            for axis, var in enumerate(cpd.variables):
+                order = [cpd.state_names[var].index(state) for state in self.state_names[var]]
+                values = np.take(values, order, axis=axis)
+            self.factors.append((values, list(cpd.variables)))
+        self.joints = {}
+
+        self.order = list(nx.topological_sort(model))
+        self.cpds = {scope[0]: (values, scope[1:]) for values, scope in self.factors}
+        self.children = {var: [child for child, (_, parents) in self.cpds.items() if var in parents] for var in self.variables}
+
+    def joint(self, variables):
+        key = tuple(variables)
+        if key not in self.joints:
+            factors = list(self.factors)
+            hidden = set(self.variables) - set(variables)
+            # sum out the hidden variables one at a time, always picking the one with the smallest merged scope
+            while hidden:
+                merged = lambda var: {v for _, scope in factors if var in scope for v in scope}
+                var = min(sorted(hidden), key=lambda v: len(merged(v)))
+                hidden.remove(var)
+                touching = [factor for factor in factors if var in factor[1]]
+                scope = [v for v in dict.fromkeys(v for _, s in touching for v in s) if v != var]
+                factors = [factor for factor in factors if var not in factor[1]] + [(contract(touching, scope), scope)]
+            self.joints[key] = contract(factors, variables)
+        return self.joints[key]
+
+    def width(self, variables):
+        return int(np.prod([len(self.state_names[v]) for v in variables]))
+
+    def assignment_index(self, variables, sample):
+        cards = [len(self.state_names[v]) for v in variables]
+        return np.ravel_multi_index([sample[v] for v in variables], cards)
+
+    def columns(self, variables):
+        assignments = list(itertools.product(*[self.state_names[v] for v in variables]))
+        if len(variables) == 1:
+            return [assignment[0] for assignment in assignments]
+        return [', '.join(f"{v}={s}" for v, s in zip(variables, assignment)) for assignment in assignments]
+
+    def batch_query(self, variables, evidence_rows):
+        if isinstance(evidence_rows, pd.DataFrame):
+            evidence_rows = evidence_rows.to_dict('records')
+        variables = list(variables)
+        width = self.width(variables)
+        posteriors = np.full((len(evidence_rows), width), np.nan)
+
+        patterns = {}
+        for i, row in enumerate(evidence_rows):
+            observed = tuple(sorted(var for var, state in row.items() if state is not None and not pd.isna(state)))
+            if set(observed) & set(variables):
+                raise ValueError(f"Row {i} gives evidence on a queried variable")
+            patterns.setdefault(observed, []).append(i)
+
+        for observed, rows in patterns.items():
+            joint = self.joint(variables + list(observed))
+            index = tuple(np.array([self.state_index[var][evidence_rows[i][var]] for i in rows]) for var in observed)
+            table = joint[(Ellipsis,) + index] if observed else np.broadcast_to(joint[..., None], joint.shape + (len(rows),))
+            table = table.reshape(width, len(rows)).T
+            totals = table.sum(axis=1, keepdims=True)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                posteriors[rows] = table / totals
+        return pd.DataFrame(posteriors, columns=self.columns(variables))
+
+def _draw(rng, probs):
+    # probs has one row per state and one column per sample
+    cdf = np.cumsum(probs, axis=0)
+    u = rng.random(probs.shape[1]) * cdf[-1]
+    return np.minimum((u[None, :] >= cdf).sum(axis=0), probs.shape[0] - 1)
+
+def _cpd_column(network, var, sample):
+    values, parents = network.cpds[var]
+    return values[(slice(None),) + tuple(sample[p] for p in parents)]
+
+def likelihood_weighting(network, variables, evidence, size, rng):
+    sample = {}
+    weights = np.ones(size)
+    for var in network.order:
+        probs = _cpd_column(network, var, sample)
+        if probs.ndim == 1:
+            probs = np.broadcast_to(probs[:, None], (len(probs), size))
+        if var in evidence:
+            sample[var] = np.full(size, evidence[var])
+            weights = weights * probs[evidence[var]]
+        else:
+            sample[var] = _draw(rng, probs)
+    return sample, weights
+
+def gibbs(network, variables, evidence, size, rng, burn_in, sweeps):
+    sample, _ = likelihood_weighting(network, variables, evidence, size, rng)
+    free = [var for var in network.order if var not in evidence]
+    collected = []
+    for sweep in range(burn_in + sweeps):
+        for var in free:
+            card = len(network.state_names[var])
+            states = np.arange(card)[:, None]
+            with np.errstate(divide='ignore'):
+                logp = np.log(np.broadcast_to(_cpd_column(network, var, sample).reshape(card, -1), (card, size)))
+                for child in network.children[var]:
+                    values, parents = network.cpds[child]
+                    index = (sample[child],) + tuple(states if p == var else sample[p] for p in parents)
+                    logp = logp + np.log(values[index])
+            best = logp.max(axis=0)
+            stuck = np.isneginf(best)
+            probs = np.exp(logp - np.where(stuck, 0, best))
+            probs[:, stuck] = np.eye(card)[sample[var][stuck]].T
+            sample[var] = _draw(rng, probs)
+        if sweep >= burn_in:
+            collected.append(network.assignment_index(variables, sample))
+    return np.stack(collected)
+
+def sample_chunk(network, method, variables, evidence, size, seed, burn_in=50, sweeps=20):
+    rng = np.random.default_rng(seed)
+    width = network.width(variables)
+    if method == 'likelihood_weighting':
+        sample, weights = likelihood_weighting(network, variables, evidence, size, rng)
+        index = network.assignment_index(variables, sample)
+        return {
+            'samples': size,
+            'sum_w': np.bincount(index, weights=weights, minlength=width),
+            'sum_w2': np.bincount(index, weights=weights ** 2, minlength=width),
+        }
+    if method == 'gibbs':
+        collected = gibbs(network, variables, evidence, size, rng, burn_in, sweeps)
+        per_chain = np.zeros((size, width))
+        for indices in collected:
+            per_chain[np.arange(size), indices] += 1
+        per_chain /= len(collected)
+        return {
+            'samples': size * sweeps,
+            'chains': size,
+            'sum_p': per_chain.sum(axis=0),
+            'sum_p2': (per_chain ** 2).sum(axis=0),
+        }
+    raise ValueError(f"Unknown sampling method {method}")
+
+def merge_stats(total, part):
+    if total is None:
+        return dict(part)
+    return {key: total[key] + part[key] for key in total}
+
+def summarize(method, stats):
+    if method == 'likelihood_weighting':
+        s1 = stats['sum_w'].sum()
+        s2 = stats['sum_w2'].sum()
+        if s1 == 0:
+            return np.full(len(stats['sum_w']), np.nan), np.full(len(stats['sum_w']), np.nan)
+        p = stats['sum_w'] / s1
+        # delta-method variance of the self-normalized (ratio) estimator
+        variance = ((1 - 2 * p) * stats['sum_w2'] + p ** 2 * s2) / s1 ** 2
+        return p, np.sqrt(np.maximum(variance, 0))
+    chains = stats['chains']
+    p = stats['sum_p'] / chains
+    variance = (stats['sum_p2'] - chains * p ** 2) / max(chains - 1, 1)
+    return p, np.sqrt(np.maximum(variance, 0) / chains)
+
+class MonteCarloInference:
+    def __init__(self, network):
+        self.network = network
+
+    def query(self, variables, evidence=None, method='likelihood_weighting', max_samples=100000,
+              tolerance=None, chunk_size=10000, workers=1, seed=None, burn_in=50, sweeps=20):
+        variables = list(variables)
+        evidence = {var: self.network.state_index[var][state] for var, state in (evidence or {}).items()}
+        # the chunk schedule and its seeds depend only on the budget, never on the worker count;
+        # workers just decide where chunks run, and the stopping rule walks them in this fixed order
+        if method == 'likelihood_weighting':
+            budget, per_chunk = max(1, max_samples), chunk_size
+        else:
+            budget, per_chunk = max(1, max_samples // sweeps), max(1, chunk_size // sweeps)
+        sizes = [per_chunk] * (budget // per_chunk) + ([budget % per_chunk] if budget % per_chunk else [])
+        children = np.random.SeedSequence(seed).spawn(len(sizes))
+        args = [(self.network, method, variables, evidence, size, child, burn_in, sweeps)
+                for size, child in zip(sizes, children)]
+        stats = None
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+        try:
+            done = False
+            for start in range(0, len(args), max(workers, 1)):
+                batch = args[start:start + max(workers, 1)]
+                if executor is None:
+                    parts = [sample_chunk(*a) for a in batch]
+                else:
+                    parts = list(executor.map(sample_chunk, *zip(*batch)))
+                for part in parts:
+                    stats = merge_stats(stats, part)
+                    p, stderr = summarize(method, stats)
+                    if tolerance is not None and np.all(Z_95 * stderr <= tolerance):
+                        done = True
+                        break
+                if done:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        result = pd.DataFrame({
+            'probability': p,
+            'stderr': stderr,
+            'ci_low': np.clip(p - Z_95 * stderr, 0, 1),
+            'ci_high': np.clip(p + Z_95 * stderr, 0, 1),
+        }, index=self.network.columns(variables))
+        result.attrs['samples'] = int(stats['samples'])
+        result.attrs['method'] = method
+        return result
+
+class JunctionTree:
+    def __init__(self, model, network, maxsize=64):
+        self.network = network
+        self.maxsize = maxsize
+        tree = model.to_junction_tree()
+        self.cliques = [tuple(clique) for clique in tree.nodes()]
+        position = {clique: i for i, clique in enumerate(self.cliques)}
+        self.neighbors = {i: [] for i in range(len(self.cliques))}
+        self.separators = {}
+        for a, b in tree.edges():
+            i, j = position[tuple(a)], position[tuple(b)]
+            self.neighbors[i].append(j)
+            self.neighbors[j].append(i)
+            self.separators[frozenset((i, j))] = tuple(v for v in self.cliques[i] if v in self.cliques[j])
+        self.home = {}
+        for var in network.variables:
+            self.home[var] = min((i for i, clique in enumerate(self.cliques) if var in clique), key=lambda i: len(self.cliques[i]))
+        self.messages = 0
+        self.propagations = 0
+
+        potentials = [np.ones([len(network.state_names[v]) for v in clique]) for clique in self.cliques]
+        for values, scope in network.factors:
+            i = min((i for i, clique in enumerate(self.cliques) if set(scope) <= set(clique)), key=lambda i: len(self.cliques[i]))
+            potentials[i] = self._einsum([potentials[i], values], [self.cliques[i], scope], self.cliques[i])
+        separators = {key: np.ones([len(network.state_names[v]) for v in sep]) for key, sep in self.separators.items()}
+        self.prior = (potentials, separators)
+        self._calibrate(self.prior)
+        self.states = OrderedDict()
+
+    def _einsum(self, arrays, scopes, output):
+        return contract(list(zip(arrays, scopes)), output)
+
+    def _pass(self, state, i, j):
+        potentials, separators = state
+        key = frozenset((i, j))
+        sep = self.separators[key]
+        new = self._einsum([potentials[i]], [self.cliques[i]], sep)
+        old = separators[key]
+        ratio = np.divide(new, old, out=np.zeros_like(new), where=old != 0)
+        potentials[j] = self._einsum([potentials[j], ratio], [self.cliques[j], sep], self.cliques[j])
+        separators[key] = new
+        self.messages += 1
+
+    def _walk(self, start):
+        order = [(start, None)]
+        for node, parent in order:
+            order.extend((child, node) for child in self.neighbors[node] if child != parent)
+        return order[1:]
+
+    def _calibrate(self, state):
+        edges = self._walk(0)
+        for child, parent in reversed(edges):
+            self._pass(state, child, parent)
+        for child, parent in edges:
+            self._pass(state, parent, child)
+        self.propagations += 1
+
+    def _enter(self, state, var, value):
+        # absorb one observation into its home clique, then push it outward from there only
+        potentials, _ = state
+        i = self.home[var]
+        indicator = np.zeros(len(self.network.state_names[var]))
+        indicator[self.network.state_index[var][value]] = 1
+        potentials[i] = self._einsum([potentials[i], indicator], [self.cliques[i], (var,)], self.cliques[i])
+        total = potentials[i].sum()
+        if total > 0:
+            potentials[i] = potentials[i] / total
+        for child, parent in self._walk(i):
+            self._pass(state, parent, child)
+        self.propagations += 1
+
+    def calibrated(self, evidence=None):
+        key = tuple(sorted((evidence or {}).items()))
+        if not key:
+            return self.prior
+        if key in self.states:
+            self.states.move_to_end(key)
+            return self.states[key]
+
+        known = set(key)
+        base_key = max((k for k in self.states if set(k) <= known), key=len, default=())
+        base = self.states[base_key] if base_key else self.prior
+        state = ([p.copy() for p in base[0]], {k: s.copy() for k, s in base[1].items()})
+        for var, value in key:
+            if (var, value) not in base_key:
+                self._enter(state, var, value)
+
+        self.states[key] = state
+        if len(self.states) > self.maxsize:
+            self.states.popitem(last=False)
+        return state
+
+    def covering_clique(self, variables):
+        candidates = [i for i, clique in enumerate(self.cliques) if set(variables) <= set(clique)]
+        return min(candidates, key=lambda i: len(self.cliques[i])) if candidates else None
+
+    def query(self, variables, evidence=None):
+        if set(variables) & set(evidence or {}):
+            raise ValueError("Can't have the same variables in both `variables` and `evidence`.")
+        i = self.covering_clique(variables)
+        if i is None:
+            return None
+        potentials, _ = self.calibrated(evidence)
+        table = self._einsum([potentials[i]], [self.cliques[i]], variables)
+        total = table.sum()
+        if total == 0:
+            return None
+        return table / total
+
+    def marginals(self, evidence=None):
+        potentials, _ = self.calibrated(evidence)
+        result = {}
+        for var in self.network.variables:
+            if var in (evidence or {}):
+                continue
+            i = self.home[var]
+            table = self._einsum([potentials[i]], [self.cliques[i]], (var,))
+            result[var] = table / table.sum()
+        return result
+
+class CachedInference:
+    def __init__(self, model, maxsize=1024):
+        self.model = model
+        self.engine = VariableElimination(model)
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.compiled = CompiledNetwork(model)
+        self._tree = None
+
+    # the junction tree is only triangulated and calibrated once a query needs it
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = JunctionTree(self.model, self.compiled)
+        return self._tree
+
+    def to_factor(self, variables, table):
+        names = self.compiled.state_names
+        return DiscreteFactor(list(variables), list(table.shape), table.ravel(),
+                              state_names={v: names[v] for v in variables})
+
+    def marginals(self, evidence=None):
+        return {var: self.to_factor([var], table) for var, table in self.tree.marginals(evidence).items()}
+
+    def batch_query(self, variables, evidence_rows):
+        return self.compiled.batch_query(variables, evidence_rows)
+
+    def approximate_query(self, variables, evidence=None, **options):
+        return MonteCarloInference(self.compiled).query(variables, evidence, **options)
+
+    @staticmethod
+    def signature(variables, evidence=None):
+        return tuple(sorted(variables)), tuple(sorted((evidence or {}).items()))
+
+    def query(self, variables, evidence=None):
+        key = self.signature(variables, evidence)
+        result = self.cache.get(key)
+        if result is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return result.copy()
+
+        self.misses += 1
+        table = self.tree.query(list(variables), evidence)
+        if table is not None:
+            result = self.to_factor(variables, table)
+        else:
+            result = self.engine.query(variables=list(variables), evidence=dict(evidence) if evidence else None)
+        self.cache[key] = result
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return result.copy()
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache), 'maxsize': self.maxsize,
+                'calibrated_states': len(self._tree.states) if self._tree else 0,
+                'propagations': self._tree.propagations if self._tree else 0,
+                'messages': self._tree.messages if self._tree else 0}
+
+    def clear(self):
+        self.cache.clear()
+        if self._tree is not None:
+            self._tree.states.clear()
+        self.hits = 0
+        self.misses = 0
@@ -1,29 +1,267 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import plotly.express as px
-from sklearn.datasets import load_wine, load_breast_cancer
-from sklearn.model_selection import KFold, GridSearchCV
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
-
-def decision_tree_cross_validation():
+import time
+# taken before any other import so --timing covers the module's own import cost
+_module_started = time.perf_counter()
+import argparse
+import hashlib
+import json
+import math
+import numbers
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# numpy, pandas, plotting and sklearn are imported inside the functions that need them,
+# so each subcommand only pays for its own imports
+
+_worker_data = None
+
+class ResultCache:
+    def __init__(self, directory='.cv_cache', max_bytes=64 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    EXECUTION_PARAMS = ('n_jobs', 'verbose')
+
+    @staticmethod
+    def key(estimator, X, y, train_idx, test_idx, *extra):
+        import numpy as np
+        import sklearn
+        digest = hashlib.sha256()
+        for array in (X, y, train_idx, test_idx):
+            array = np.ascontiguousarray(np.asarray(array))
+            digest.update(f"{array.dtype}{array.shape}".encode())
+            digest.update(array.tobytes())
+        # parallelism and logging don't change the fitted model, so they must not split the cache
+        params = {name: value for name, value in estimator.get_params(deep=False).items()
+                  if name not in ResultCache.EXECUTION_PARAMS}
+        # scores from another library release may differ, so an upgrade starts a fresh cache
+        spec = (sklearn.__version__, np.__version__, type(estimator).__module__, type(estimator).__qualname__,
+                sorted(params.items()), extra)
+        digest.update(repr(spec).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def reproducible(estimator):
+        # an unseeded estimator gives a different result every fit, so replaying one would change the experiment
+        seed = estimator.get_params(deep=False).get('random_state', 0)
+        return isinstance(seed, numbers.Integral)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            # the modification time doubles as the last-used time for eviction
+            os.utime(self.path(key))
+        except OSError:
+            # another worker evicted it after we read it; the value is still good
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        temp = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(value, f)
+        os.replace(temp, self.path(key))
+        self.evict()
+
+    def fetch(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def _share_data(X, y, cache=None):
+    global _worker_data
+    _worker_data = (X, y, cache)
+
+def _init_worker(X, y, fit_jobs, cache=None):
+    from threadpoolctl import threadpool_limits
+    # keep BLAS/OpenMP pools inside each worker process from oversubscribing the cores;
+    # the cap lasts only as long as the worker does
+    threadpool_limits(fit_jobs)
+    _share_data(X, y, cache)
+
+def fit_fold(estimator, X, y, train_idx, test_idx, cache=None):
+    from sklearn.base import clone
+    from sklearn.utils import _safe_indexing
+
+    def compute():
+        clf = clone(estimator)
+        clf.fit(_safe_indexing(X, train_idx), _safe_indexing(y, train_idx))
+        return clf.score(_safe_indexing(X, test_idx), _safe_indexing(y, test_idx))
+
+    if cache is None or not cache.reproducible(estimator):
+        return compute()
+    return cache.fetch(cache.key(estimator, X, y, train_idx, test_idx), compute)
+
+def grow_and_score(estimator, param, values, X, y, train_idx, test_idx, train_score=False, cache=None):
+    from sklearn.base import clone
+    from sklearn.utils import _safe_indexing
+
+    def compute():
+        X_train, y_train = _safe_indexing(X, train_idx), _safe_indexing(y, train_idx)
+        X_test, y_test = _safe_indexing(X, test_idx), _safe_indexing(y, test_idx)
+        # refitting with warm_start only adds the trees/iterations beyond the previous checkpoint,
+        # and yields the same model as a fresh fit at that size
+        model = clone(estimator).set_params(warm_start=True)
+        checkpoints = {}
+        fit_time = 0.0
+        for value in sorted(values):
+            start = time.perf_counter()
+            model.set_params(**{param: value}).fit(X_train, y_train)
+            fit_time += time.perf_counter() - start
+            start = time.perf_counter()
+            test = model.score(X_test, y_test)
+            score_time = time.perf_counter() - start
+            train = model.score(X_train, y_train) if train_score else None
+            checkpoints[value] = [test, train, fit_time, score_time]
+        return [checkpoints[value] for value in values]
+
+    if cache is None or not cache.reproducible(estimator):
+        return compute()
+    return cache.fetch(cache.key(estimator, X, y, train_idx, test_idx, param, list(values), train_score), compute)
+
+def _grow_forest(task):
+    from sklearn.ensemble import RandomForestClassifier
+    criterion, n_estimators_list, train_idx, test_idx, fit_jobs = task
+    X, y, cache = _worker_data
+    clf = RandomForestClassifier(criterion=criterion, random_state=42, n_jobs=fit_jobs)
+    checkpoints = grow_and_score(clf, 'n_estimators', n_estimators_list, X, y, train_idx, test_idx, cache=cache)
+    return [test for test, _, _, _ in checkpoints]
+
+def warm_start_search(estimator, param, values, X, y, cv, return_train_score=False, cache=None):
+    import numpy as np
+    from scipy.stats import rankdata
+
+    folds = [grow_and_score(estimator, param, values, X, y, train_idx, test_idx, return_train_score, cache)
+             for train_idx, test_idx in cv.split(X, y)]
+    # (folds, values, [test, train, fit_time, score_time])
+    table = np.array([[[np.nan if v is None else v for v in checkpoint] for checkpoint in fold] for fold in folds])
+
+    results = {
+        'mean_fit_time': table[:, :, 2].mean(axis=0),
+        'std_fit_time': table[:, :, 2].std(axis=0),
+        'mean_score_time': table[:, :, 3].mean(axis=0),
+        'std_score_time': table[:, :, 3].std(axis=0),
+        f"param_{param}": np.array(values),
+        'params': [{param: value} for value in values],
+    }
+    for kind, column in (('test', 0), ('train', 1)):
+        if kind == 'train' and not return_train_score:
+            continue
+        for i in range(len(folds)):
+            results[f"split{i}_{kind}_score"] = table[i, :, column]
+        results[f"mean_{kind}_score"] = table[:, :, column].mean(axis=0)
+        results[f"std_{kind}_score"] = table[:, :, column].std(axis=0)
+        if kind == 'test':
+            results['rank_test_score'] = rankdata(-results['mean_test_score'], method='min').astype(np.int32)
+    return results
+
+def successive_halving(estimator, param, values, X, y, cv, factor=2, budget=None, max_fits=None, cache=None):
+    import numpy as np
+
+    if factor < 2:
+        raise ValueError(f"halving factor must be at least 2, got {factor}")
+
+    # race the candidates over folds: every round the survivors are scored on `factor` times
+    # more folds and only the best 1/factor of them go on, until one has the full cross-validation
+    folds = list(cv.split(X, y))
+    scores = {value: [] for value in values}
+    fit_times = {value: [] for value in values}
+    reached = {value: 0 for value in values}
+    survivors = list(values)
+    used = 1
+    fits = 0
+    start = time.perf_counter()
+    exhausted = lambda: ((budget is not None and time.perf_counter() - start >= budget) or
+                         (max_fits is not None and fits >= max_fits))
+    mean = lambda value: np.mean(scores[value]) if scores[value] else -np.inf
+
+    for round_index in range(len(values) * len(folds)):
+        for value in survivors:
+            reached[value] = round_index
+            for train_idx, test_idx in folds[len(scores[value]):used]:
+                if exhausted():
+                    break
+                [(test, _, fit_time, _)] = grow_and_score(estimator, param, [value], X, y, train_idx, test_idx, cache=cache)
+                scores[value].append(test)
+                fit_times[value].append(fit_time)
+                fits += 1
+        if exhausted() or (len(survivors) == 1 and used == len(folds)):
+            break
+        survivors = sorted(survivors, key=mean, reverse=True)[:math.ceil(len(survivors) / factor)]
+        used = min(len(folds), used * factor)
+
+    most = max(len(scores[value]) for value in values)
+    leaders = [value for value in values if scores[value] and len(scores[value]) == most]
+    results = {
+        f"param_{param}": np.array(values),
+        'params': [{param: value} for value in values],
+        'n_folds': np.array([len(scores[value]) for value in values]),
+        'iter': np.array([reached[value] for value in values]),
+        'mean_test_score': np.array([np.mean(scores[value]) if scores[value] else np.nan for value in values]),
+        'std_test_score': np.array([np.std(scores[value]) if scores[value] else np.nan for value in values]),
+        'mean_fit_time': np.array([np.mean(fit_times[value]) if fit_times[value] else np.nan for value in values]),
+    }
+    summary = {
+        'best': max(leaders, key=mean) if leaders else None,
+        'fits': fits,
+        'fit_seconds': sum(sum(times) for times in fit_times.values()),
+        'elapsed': time.perf_counter() - start,
+        'exhausted': exhausted(),
+    }
+    return results, summary
+
+def decision_tree_cross_validation(cache=None, output_dir=None):
+    from sklearn.datasets import load_wine
+    from sklearn.model_selection import KFold
+    from sklearn.tree import DecisionTreeClassifier
+
     wine = load_wine()
     X, y = wine.data, wine.target
     kf = KFold(n_splits=5, shuffle=True, random_state=42)
     scores = []
 
     for train_idx, test_idx in kf.split(X):
-        X_train, X_test = X[train_idx], X[test_idx]
-        y_train, y_test = y[train_idx], y[test_idx]
-
-        clf = DecisionTreeClassifier()
-        clf.fit(X_train, y_train)
-        score = clf.score(X_test, y_test)
+        score = fit_fold(DecisionTreeClassifier(), X, y, train_idx, test_idx, cache)
         scores.append(score)
 
     print(f"Cross-validation scores: {scores}")
+    if output_dir:
+        with open(os.path.join(output_dir, 'decision_tree_scores.json'), 'w') as f:
+            json.dump({'scores': scores, 'mean': sum(scores) / len(scores)}, f, indent=2)
+
+def random_forest_grid_search(workers=1, backend='process', fit_jobs=1, cache=None, output_dir=None):
+    from sklearn.datasets import load_wine
+    from sklearn.model_selection import KFold
 
-def random_forest_grid_search():
     wine = load_wine()
     X, y = wine.data, wine.target
     n_estimators_list = [10, 25, 50]
@@ -31,22 +269,31 @@ def random_forest_grid_search():
     results = []
 
     kf = KFold(n_splits=5, shuffle=True, random_state=42)
+    folds = list(kf.split(X))
+    # one forest per (criterion, fold) is grown through every n_estimators checkpoint
+    tasks = [(criterion, n_estimators_list, train_idx, test_idx, fit_jobs)
+             for criterion in criteria
+             for train_idx, test_idx in folds]
 
-    for criterion in criteria:
-        for n_estimators in n_estimators_list:
-            scores = []
-
-            for train_idx, test_idx in kf.split(X):
-                X_train, X_test = X[train_idx], X[test_idx]
-                y_train, y_test = y[train_idx], y[test_idx]
-
-                clf = RandomForestClassifier(n_estimators=n_estimators,
-                                             criterion=criterion,
-                                             random_state=42)
-                clf.fit(X_train, y_train)
-                score = clf.score(X_test, y_test)
-                scores.append(score)
+    # every fit carries its own fixed seed, so results do not depend on scheduling
+    if workers > 1 and backend == 'process':
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(X, y, fit_jobs, cache)) as executor:
+            fold_scores = list(executor.map(_grow_forest, tasks))
+    else:
+        from threadpoolctl import threadpool_limits
+        _share_data(X, y, cache)
+        # in this process the cap must be lifted again afterwards, or later experiments inherit it
+        with threadpool_limits(fit_jobs):
+            if workers <= 1:
+                fold_scores = [_grow_forest(task) for task in tasks]
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    fold_scores = list(executor.map(_grow_forest, tasks))
 
+    for c, criterion in enumerate(criteria):
+        for n, n_estimators in enumerate(n_estimators_list):
+            scores = [fold[n] for fold in fold_scores[c * len(folds):(c + 1) * len(folds)]]
             avg_score = sum(scores) / len(scores)
             results.append({
                 'Criterion': criterion,
@@ -55,6 +302,12 @@ def random_forest_grid_search():
                 'Average Score': avg_score
             })
 
+    import pandas as pd
+    if output_dir:
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     df_results = pd.DataFrame(results)
     df_results['Average Score'] = df_results['Average Score'].round(4)
 
@@ -65,10 +318,23 @@ def random_forest_grid_search():
     ax.axis('off')
     ax.table(cellText=table.values, colLabels=table.columns, loc='center')
     plt.tight_layout()
-    plt.savefig('random_forest_results.png', dpi=300)
-    plt.show()
+    if output_dir:
+        plt.savefig(os.path.join(output_dir, 'random_forest_results.png'), dpi=300)
+        plt.close(fig)
+        df_results.to_csv(os.path.join(output_dir, 'random_forest_results.csv'), index=False)
+    else:
+        plt.savefig('random_forest_results.png', dpi=300)
+        plt.show()
+
+def hyperparameter_search_comparison(cache=None, search='grid', budget=None, max_fits=None, factor=2, compare_grid=False,
+                                     output_dir=None):
+    import numpy as np
+    import pandas as pd
+    import plotly.express as px
+    from sklearn.datasets import load_breast_cancer
+    from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
+    from sklearn.model_selection import KFold
 
-def hyperparameter_search_comparison():
     X, y = load_breast_cancer(return_X_y=True, as_frame=True)
 
     models = {
@@ -77,21 +343,31 @@ def hyperparameter_search_comparison():
     }
 
     param_grids = {
-        "Random Forest": {"n_estimators": [5, 10, 15, 20]},
-        "Hist Gradient Boosting": {"max_iter": [25, 50, 75, 100]}
+        "Random Forest": ("n_estimators", [5, 10, 15, 20]),
+        "Hist Gradient Boosting": ("max_iter", [25, 50, 75, 100])
     }
 
     cv = KFold(n_splits=5, shuffle=True, random_state=0)
     all_results = pd.DataFrame()
 
     for name, model in models.items():
-        grid_search = GridSearchCV(estimator=model,
-                                   param_grid=param_grids[name],
-                                   cv=cv,
-                                   return_train_score=True)
-        grid_search.fit(X, y)
+        param, values = param_grids[name]
+        if search == 'halving':
+            cv_results, summary = successive_halving(model, param, values, X, y, cv, factor, budget, max_fits, cache)
+            print(f"{name}: successive halving picked {param}={summary['best']} after {summary['fits']} fits, "
+                  f"{summary['fit_seconds']:.3f}s fitting{' (budget exhausted)' if summary['exhausted'] else ''}")
+            if compare_grid:
+                grid = warm_start_search(model, param, values, X, y, cv, cache=cache)
+                grid_best = values[int(np.argmin(grid['rank_test_score']))]
+                # fit times are cumulative per checkpoint, i.e. what independent fits at each size cost
+                grid_seconds = grid['mean_fit_time'].sum() * cv.get_n_splits()
+                print(f"{name}: exhaustive grid picked {param}={grid_best} after {len(values) * cv.get_n_splits()} fits, "
+                      f"{grid_seconds:.3f}s fitting; halving saved {grid_seconds - summary['fit_seconds']:.3f}s "
+                      f"({1 - summary['fit_seconds'] / grid_seconds:.0%}), same winner: {grid_best == summary['best']}")
+        else:
+            cv_results = warm_start_search(model, param, values, X, y, cv, return_train_score=True, cache=cache)
 
-        cv_results_df = pd.DataFrame(grid_search.cv_results_)
+        cv_results_df = pd.DataFrame(cv_results)
         cv_results_df['model'] = name
         all_results = pd.concat([all_results, cv_results_df], ignore_index=True)
 
@@ -100,16 +376,73 @@ def hyperparameter_search_comparison():
     fig_rf = px.scatter(rf_results, x='n_estimators', y='mean_test_score',
                         title='Random Forest Performance',
                         labels={'n_estimators': 'Number of Estimators', 'mean_test_score': 'Mean Test Score'})
-    fig_rf.show()
+    if output_dir:
+        fig_rf.write_html(os.path.join(output_dir, 'random_forest_search.html'))
+    else:
+        fig_rf.show()
 
     hgb_results = all_results[all_results['model'] == 'Hist Gradient Boosting']
     hgb_results.loc[:, 'max_iter'] = hgb_results['param_max_iter'].astype(int)
     fig_hgb = px.scatter(hgb_results, x='max_iter', y='mean_test_score',
                          title='Histogram Gradient Boosting Performance',
                          labels={'max_iter': 'Number of Iterations', 'mean_test_score': 'Mean Test Score'})
-    fig_hgb.show()
+    if output_dir:
+        fig_hgb.write_html(os.path.join(output_dir, 'hist_gradient_boosting_search.html'))
+        all_results.to_csv(os.path.join(output_dir, 'hyperparameter_search_results.csv'), index=False)
+    else:
+        fig_hgb.show()
+
+def halving_factor(value):
+    factor = int(value)
+    if factor < 2:
+        raise argparse.ArgumentTypeError(f"expected an integer >= 2, got {value}")
+    return factor
+
+def main():
+    imported = time.perf_counter()
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--output_dir', type=str, help='Run headless: write plots and results here instead of showing them')
+    common.add_argument('--cache_dir', type=str, default='.cv_cache', help='Directory for cached fold results')
+    common.add_argument('--cache_mb', type=float, default=64, help='Size limit of the result cache in megabytes')
+    common.add_argument('--no_cache', action='store_true', help='Refit everything without reading or writing the cache')
+    common.add_argument('--timing', action='store_true', help='Report import, start-up (from module load) and experiment wall-clock time')
+
+    forest = argparse.ArgumentParser(add_help=False)
+    forest.add_argument('--workers', type=int, default=os.cpu_count(), help='Parallel fits in the random forest grid search')
+    forest.add_argument('--backend', choices=['process', 'thread'], default='process', help='Pool used to run the fits')
+    forest.add_argument('--fit_jobs', type=int, default=1, help='Threads used inside each forest fit')
+
+    search = argparse.ArgumentParser(add_help=False)
+    search.add_argument('--search', choices=['grid', 'halving'], default='grid', help='Hyperparameter search strategy for the comparison')
+    search.add_argument('--budget', type=float, help='Wall-clock seconds allowed for successive halving')
+    search.add_argument('--max_fits', type=int, help='Number of fits allowed for successive halving')
+    search.add_argument('--halving_factor', type=halving_factor, default=2, help='Fraction of candidates kept (1/factor) and fold growth per round')
+    search.add_argument('--compare_grid', action='store_true', help='Also run the exhaustive grid and report time saved and winner agreement')
+
+    parser = argparse.ArgumentParser(description='Decision tree and forest experiments')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('tree', parents=[common], help='Decision tree cross-validation on the wine dataset')
+    commands.add_parser('forest', parents=[common, forest], help='Random forest criterion and size grid on the wine dataset')
+    commands.add_parser('search', parents=[common, search], help='Forest vs gradient boosting search on breast cancer')
+    commands.add_parser('all', parents=[common, forest, search], help='Run every experiment')
+    args = parser.parse_args()
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    cache = None if args.no_cache else ResultCache(args.cache_dir, int(args.cache_mb * 2**20))
+    ready = time.perf_counter()
+
+    if args.command in ('tree', 'all'):
+        decision_tree_cross_validation(cache, args.output_dir)
+    if args.command in ('forest', 'all'):
+        random_forest_grid_search(args.workers, args.backend, args.fit_jobs, cache, args.output_dir)
+    if args.command in ('search', 'all'):
+        hyperparameter_search_comparison(cache, args.search, args.budget, args.max_fits, args.halving_factor,
+                                         args.compare_grid, args.output_dir)
+
+    if args.timing:
+        print(f"imports {imported - _module_started:.3f}s, start-up {ready - _module_started:.3f}s, "
+              f"{args.command} {time.perf_counter() - ready:.3f}s")
 
 if __name__ == "__main__":
-    decision_tree_cross_validation()
-    random_forest_grid_search()
-    hyperparameter_search_comparison()
+    main()